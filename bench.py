@@ -0,0 +1,345 @@
+from datetime import datetime
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import string
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import chatfilter
+import fastjson
+from logparse import TIME_FORMAT, expand_paths, iter_log, open_log
+
+
+def timed(fn, items, repeat):
+    # best of repeat runs, in microseconds per item
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(items) * 1e6
+
+def random_word(rng, min_len=3, max_len=10):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(min_len, max_len)))
+
+def random_message(rng, words, hit_rate):
+    text = []
+    for _ in range(rng.randint(1, 12)):
+        text.append(rng.choice(words) if rng.random() < hit_rate else random_word(rng, 1, 8))
+    return " ".join(text)
+
+def log_messages(paths, limit):
+    messages = []
+    for path in expand_paths(paths):
+        for item in iter_log(path):
+            if item.get("action") == "message":
+                messages.append(item.get("message", {}).get("data", ""))
+                if len(messages) == limit:
+                    return messages
+    return messages
+
+def bench_filter(args):
+    rng = random.Random(args.seed)
+    if args.wordlist:
+        patterns = chatfilter.read_wordlist(args.wordlist)
+    else:
+        patterns = [(random_word(rng), rng.choice(chatfilter.ACTIONS)) for _ in range(args.terms)]
+    words = [pattern for pattern, _ in patterns]
+
+    if args.log:
+        messages = log_messages(args.log, args.messages)
+    else:
+        messages = [random_message(rng, words, args.hit_rate) for _ in range(args.messages)]
+    if not messages:
+        sys.exit("no messages to filter")
+
+    start = time.perf_counter()
+    chat_filter = chatfilter.ChatFilter(None)
+    chat_filter.set_patterns(patterns)
+    build = time.perf_counter() - start
+
+    regexes = [re.compile(r"\b" + re.escape(word) + r"\b", re.IGNORECASE) for word in words]
+    def regex_check(text):
+        return [regex for regex in regexes if regex.search(text)]
+
+    mean_len = sum(len(m) for m in messages) / len(messages)
+    hits = sum(1 for m in messages if chat_filter.check(m)[0])
+    print(f"{len(patterns)} patterns, {len(chat_filter.automaton)} states, built in {build * 1000:.1f}ms")
+    print(f"{len(messages)} messages, mean length {mean_len:.0f}, {hits} matched")
+
+    automaton_us = timed(chat_filter.check, messages, args.repeat)
+    print(f"automaton:      {automaton_us:10.2f} us/message")
+    if not args.no_baseline:
+        # the regex loop is slow, a slice of the messages is enough
+        sample = messages[:max(1, len(messages) // 10)]
+        regex_us = timed(regex_check, sample, 1)
+        print(f"regex per word: {regex_us:10.2f} us/message ({regex_us / automaton_us:.0f}x slower)")
+
+def log_lines(paths, limit):
+    lines = []
+    for path in expand_paths(paths):
+        with open_log(path) as f:
+            for line in f:
+                lines.append(line)
+                if len(lines) == limit:
+                    return lines
+    return lines
+
+def bench_json(args):
+    rng = random.Random(args.seed)
+    image = "".join(rng.choice(string.ascii_letters + string.digits + "+/") for _ in range(3068))
+    drawing = {"type": 0, "user": "someone", "data": "hello there", "image": image}
+    inbound = json.dumps({"action": "message", "room": "A", "message": drawing})
+    entry = {"action": "message", "room": "A", "message": drawing, "remote": ["127.0.0.1", 50000]}
+    if args.log:
+        lines = log_lines(args.log, args.lines)
+    else:
+        lines = [json.dumps(dict(entry, timestamp="2021-06-01 12:00:00"))] * args.lines
+
+    # what the server did before: a strftime for the record and another
+    # for stdout, and the entry serialized once for each. both return the
+    # (line, printed) pair the log queue holds
+    def log_before(entry):
+        entry["timestamp"] = datetime.now().strftime(TIME_FORMAT)
+        printed = f"[{datetime.now().strftime(TIME_FORMAT)}] {json.dumps(entry)}"
+        return json.dumps(entry), printed
+
+    def log_after(entry):
+        entry["timestamp"] = fastjson.timestamp()
+        line = fastjson.dumps(entry)
+        printed = f"[{fastjson.timestamp()}] {line}"
+        return line, printed
+
+    n = args.iterations
+    paths = [
+        ("inbound parse", json.loads, fastjson.loads, [inbound] * n),
+        ("fan-out dumps", json.dumps, fastjson.dumps, [{"type": "message", "message": drawing}] * n),
+        ("log entry", log_before, log_after, [dict(entry) for _ in range(n)]),
+        ("log load", json.loads, fastjson.loads, lines),
+    ]
+    print(f"backend: {fastjson.BACKEND}" + ("" if fastjson.orjson else " (orjson not installed)"))
+    print(f"{'path':<16} {'json us':>10} {'now us':>10} {'gain':>8}")
+    for name, before, after, items in paths:
+        before_us = timed(before, items, args.repeat)
+        after_us = timed(after, items, args.repeat)
+        print(f"{name:<16} {before_us:>10.2f} {after_us:>10.2f} {before_us / after_us:>7.1f}x")
+
+# run in a fresh interpreter per sample: import the tool, then build its
+# window and let Tk draw it once. prints import and window seconds, window
+# is -1 when there is no display to open it on
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+import tkinter as tk
+try:
+    {create}
+    app.mainwindow.update()
+    shown = time.perf_counter() - imported
+except tk.TclError:
+    shown = -1
+print(imported - start, shown)
+"""
+
+STARTUP_TOOLS = {
+    "logview": "tk.Tk(); app = logview.LogViewApp()",
+    "layout": "app = layout.LayoutApp()",
+}
+
+# what the tools no longer load before their window is up
+DEFERRED_IMPORTS = ("PIL.ImageTk", "concurrent.futures", "logindex", "logsimilar")
+
+def run_timed(code, cwd):
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True, check=True).stdout
+    return time.perf_counter() - start, out.split()
+
+def bench_startup(args):
+    for tool in args.tools:
+        if tool not in STARTUP_TOOLS:
+            sys.exit(f"unknown tool {tool}")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    baseline = statistics.median(run_timed("pass", cwd)[0] for _ in range(args.runs))
+    print(f"interpreter alone: {baseline * 1000:.0f}ms")
+    print(f"{'tool':<10} {'process ms':>11} {'import ms':>10} {'window ms':>10}")
+    for tool in args.tools:
+        code = STARTUP_SCRIPT.format(module=tool, create=STARTUP_TOOLS[tool])
+        total, imported, shown = [], [], []
+        for _ in range(args.runs):
+            elapsed, (import_s, window_s) = run_timed(code, cwd)
+            total.append(elapsed)
+            imported.append(float(import_s))
+            shown.append(float(window_s))
+        window = f"{statistics.median(shown) * 1000:>10.0f}" if min(shown) >= 0 else f"{'no display':>10}"
+        print(f"{tool:<10} {statistics.median(total) * 1000:>11.0f} {statistics.median(imported) * 1000:>10.0f} {window}")
+
+    # measured on top of the tools' own imports, so shared modules do not count
+    print("loaded on first use instead:")
+    preload = ", ".join(args.tools)
+    for module in DEFERRED_IMPORTS:
+        code = f"import time, {preload}; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        cost = statistics.median(float(run_timed(code, cwd)[1][0]) for _ in range(args.runs))
+        print(f"  {module:<20} {cost * 1000:>6.0f}ms")
+
+def random_drawing(rng):
+    # a few strokes on white, packed like the client does (see logimage)
+    from base64 import b64encode
+    from PIL import Image, ImageDraw
+    from logimage import IMAGE_SIZE
+    im = Image.new("L", IMAGE_SIZE, 255)
+    draw = ImageDraw.Draw(im)
+    for _ in range(rng.randint(1, 8)):
+        points = [(rng.randrange(IMAGE_SIZE[0]), rng.randrange(IMAGE_SIZE[1])) for _ in range(rng.randint(2, 6))]
+        draw.line(points, fill=0, width=rng.choice((1, 2, 3)))
+    line = Image.frombytes("L", (IMAGE_SIZE[0] * IMAGE_SIZE[1], 1), im.tobytes()).convert("1")
+    return b64encode(line.tobytes("raw", "1;IR")).decode()
+
+def outbound_traffic(args, rng):
+    # [(payload, recipients)]: drawings go to the whole room, control
+    # replies to one client
+    control = [
+        {"type": "status", "roomA": 3, "roomB": 0, "roomC": 12, "roomD": 1},
+        {"type": "username", "valid": True},
+        {"type": "join", "success": True},
+        {"type": "message", "message": {"type": 0, "data": "someone", "user": ""}},
+    ]
+    messages = []
+    if args.log:
+        for path in expand_paths(args.log):
+            for item in iter_log(path):
+                if item.get("action") == "message" and "message" in item:
+                    messages.append({"type": "message", "message": item["message"]})
+                    if len(messages) == args.messages:
+                        break
+    else:
+        for _ in range(args.messages):
+            image = random_drawing(rng) if rng.random() < args.image_rate else ""
+            messages.append({"type": "message", "message": {"type": 0, "user": "someone", "data": random_word(rng), "image": image}})
+
+    traffic = []
+    for message in messages:
+        traffic.append((fastjson.dumps(message).encode(), args.room))
+        for _ in range(args.control):
+            traffic.append((fastjson.dumps(rng.choice(control)).encode(), 1))
+    return traffic
+
+def deflate_variants(args):
+    from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+    import wsdeflate
+    policy = wsdeflate.DeflatePolicy(args.min_size, True)
+    every = wsdeflate.DeflatePolicy(0, False)
+    def tuned(policy, context_takeover):
+        return wsdeflate.PolicyDeflateFactory(policy, args.window_bits, args.mem_level, args.level, context_takeover)
+    return [
+        ("off", None),
+        ("websockets default", ServerPerMessageDeflateFactory()),
+        ("every frame, tuned", tuned(every, False)),
+        ("policy, takeover", tuned(policy, True)),
+        ("policy", tuned(policy, False)),
+    ]
+
+def bench_deflate(args):
+    from websockets.frames import OP_TEXT, Frame
+    rng = random.Random(args.seed)
+    traffic = outbound_traffic(args, rng)
+    raw = sum(len(payload) * recipients for payload, recipients in traffic)
+    frames = sum(recipients for _, recipients in traffic)
+    print(f"{len(traffic)} payloads, {frames} frames sent, {raw / 1024:.0f}K uncompressed")
+    print(f"window {args.window_bits} bits, memLevel {args.mem_level}, level {args.level}, min size {args.min_size}")
+    print(f"{'variant':<20} {'us/frame':>9} {'wire':>7} {'state/conn':>11}")
+
+    # browsers offer client_max_window_bits without a value
+    offer = [("client_max_window_bits", None)]
+    for name, factory in deflate_variants(args):
+        def connect(n):
+            return [factory.process_request_params(offer, [])[1] for _ in range(n)] if factory else []
+
+        def send_all(connections):
+            wire = 0
+            for payload, recipients in traffic:
+                for i in range(recipients):
+                    frame = Frame(fin=True, opcode=OP_TEXT, data=payload)
+                    if connections:
+                        frame = connections[i % len(connections)].encode(frame)
+                    wire += len(frame.data)
+            return wire
+
+        best = None
+        for _ in range(args.repeat):
+            connections = connect(args.room)
+            start = time.perf_counter()
+            wire = send_all(connections)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        # zlib allocates through PyMem_RawMalloc, so tracemalloc sees its
+        # state; what is left after the traffic is what each connection keeps
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        connections = connect(args.connections)
+        for i in range(0, len(connections), args.room):
+            for payload, recipients in traffic[:args.warmup]:
+                for connection in connections[i:i + min(recipients, args.room)]:
+                    connection.encode(Frame(fin=True, opcode=OP_TEXT, data=payload))
+        state = (tracemalloc.get_traced_memory()[0] - before) / max(1, len(connections))
+        tracemalloc.stop()
+        del connections
+
+        print(f"{name:<20} {best / frames * 1e6:>9.2f} {wire / raw:>6.1%} {state / 1024:>10.1f}K")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="micro-benchmarks for the server's hot paths")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    filter_parser = commands.add_parser("filter", help="chat filter cost per message")
+    filter_parser.add_argument("-w", "--wordlist", default=None, help="wordlist file (default: random words)")
+    filter_parser.add_argument("-t", "--terms", type=int, default=5000, help="random terms when no wordlist is given")
+    filter_parser.add_argument("-m", "--messages", type=int, default=20000)
+    filter_parser.add_argument("--log", nargs="+", default=None, help="take messages from these logs instead")
+    filter_parser.add_argument("--hit-rate", type=float, default=0.01, help="share of random words taken from the list")
+    filter_parser.add_argument("-r", "--repeat", type=int, default=3)
+    filter_parser.add_argument("--no-baseline", action="store_true", help="skip the one-regex-per-word comparison")
+    filter_parser.add_argument("--seed", type=int, default=0)
+    filter_parser.set_defaults(run=bench_filter)
+
+    json_parser = commands.add_parser("json", help="serialization cost on the server and log paths")
+    json_parser.add_argument("-n", "--iterations", type=int, default=20000)
+    json_parser.add_argument("--log", nargs="+", default=None, help="time loading these logs instead of synthetic lines")
+    json_parser.add_argument("-l", "--lines", type=int, default=20000, help="log lines to load")
+    json_parser.add_argument("-r", "--repeat", type=int, default=5)
+    json_parser.add_argument("--seed", type=int, default=0)
+    json_parser.set_defaults(run=bench_json)
+
+    startup_parser = commands.add_parser("startup", help="time from launch to window for the tk tools")
+    startup_parser.add_argument("tools", nargs="*", default=list(STARTUP_TOOLS), help=f"any of {', '.join(STARTUP_TOOLS)} (default: all)")
+    startup_parser.add_argument("-n", "--runs", type=int, default=10, help="fresh processes per tool (median is shown)")
+    startup_parser.set_defaults(run=bench_startup)
+
+    deflate_parser = commands.add_parser("deflate", help="permessage-deflate cpu, bandwidth and memory per policy")
+    deflate_parser.add_argument("-m", "--messages", type=int, default=500, help="chat messages (each broadcast to a room)")
+    deflate_parser.add_argument("--log", nargs="+", default=None, help="take messages from these logs instead")
+    deflate_parser.add_argument("--image-rate", type=float, default=0.8, help="share of random messages with a drawing")
+    deflate_parser.add_argument("--room", type=int, default=8, help="recipients per broadcast")
+    deflate_parser.add_argument("--control", type=int, default=3, help="small control replies per message")
+    deflate_parser.add_argument("-c", "--connections", type=int, default=200, help="connections for the memory figure")
+    deflate_parser.add_argument("--warmup", type=int, default=50, help="payloads sent on each connection before measuring memory")
+    deflate_parser.add_argument("-w", "--window-bits", type=int, default=12)
+    deflate_parser.add_argument("--mem-level", type=int, default=5)
+    deflate_parser.add_argument("--level", type=int, default=6)
+    deflate_parser.add_argument("--min-size", type=int, default=512)
+    deflate_parser.add_argument("-r", "--repeat", type=int, default=3)
+    deflate_parser.add_argument("--seed", type=int, default=0)
+    deflate_parser.set_defaults(run=bench_deflate)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,134 @@
+from collections import deque
+import os
+import time
+
+# in increasing severity, the strongest match decides what happens
+ACTIONS = ("mask", "flag", "drop", "finish_him")
+
+class Automaton:
+    # aho-corasick: one pass over the text finds every pattern in it
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for pattern, value in patterns:
+            state = 0
+            for c in pattern:
+                next_state = self.goto[state].get(c)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][c] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = next_state
+            self.out[state] += ((len(pattern), value),)
+
+        # breadth first, so a state's fail link is done before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[next_state] = self.goto[f].get(c, 0)
+                self.out[next_state] += self.out[self.fail[next_state]]
+
+    def __len__(self):
+        return len(self.goto)
+
+    def search(self, text):
+        # [(start, end, value)] for every occurrence, overlaps included
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        hits = []
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                for length, value in out[state]:
+                    hits.append((i - length + 1, i + 1, value))
+        return hits
+
+def read_wordlist(path):
+    # one pattern per line, optionally prefixed with an action:
+    #   badword
+    #   drop some phrase
+    #   finish_him worse
+    # lines without an action are masked, # starts a comment
+    patterns = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip().lower()
+            if not line or line.startswith("#"):
+                continue
+            action, _, pattern = line.partition(" ")
+            if action not in ACTIONS or not pattern.strip():
+                action, pattern = "mask", line
+            patterns.append((pattern.strip(), action))
+    return patterns
+
+def is_word_char(c):
+    return c.isalnum() or c == "_"
+
+class ChatFilter:
+    RELOAD_INTERVAL = 2.0 # seconds between checks of the wordlist's mtime
+
+    def __init__(self, path="filter.txt"):
+        self.path = path
+        self.mtime = None
+        self.checked = 0
+        self.patterns = 0
+        self.automaton = Automaton([])
+        self.reload()
+
+    def set_patterns(self, patterns):
+        self.automaton = Automaton(patterns)
+        self.patterns = len(patterns)
+
+    def reload(self):
+        if self.path is None:
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        self.set_patterns(read_wordlist(self.path) if mtime is not None else [])
+        self.mtime = mtime
+        return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self.checked < self.RELOAD_INTERVAL:
+            return False
+        self.checked = now
+        return self.reload()
+
+    def check(self, text):
+        # returns (action, text with masked words, matched words); action
+        # is None when nothing matched. matches have to be whole words,
+        # so "class" does not trip over "ass"
+        lowered = text.lower()
+        hits = []
+        for start, end, action in self.automaton.search(lowered):
+            if start > 0 and is_word_char(lowered[start - 1]):
+                continue
+            if end < len(lowered) and is_word_char(lowered[end]):
+                continue
+            hits.append((start, end, action))
+        if not hits:
+            return None, text, []
+
+        action = max((hit[2] for hit in hits), key=ACTIONS.index)
+        chars = list(text)
+        for start, end, hit_action in hits:
+            if hit_action == "mask":
+                chars[start:end] = "*" * (end - start)
+        return action, "".join(chars), sorted(set(lowered[start:end] for start, end, _ in hits))
@@ -0,0 +1,38 @@
+import json
+import time
+
+# orjson when it is installed, the standard library otherwise. output is
+# always str so it can go straight into a websocket text frame or a file
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson:
+    BACKEND = "orjson"
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+else:
+    BACKEND = "json"
+    dumps = json.dumps
+    loads = json.loads
+
+class SecondClock:
+    # log timestamps only have whole seconds, so each string is formatted
+    # once and reused until the second changes
+    def __init__(self, fmt="%Y-%m-%d %H:%M:%S"):
+        self.fmt = fmt
+        self.second = None
+        self.string = ""
+
+    def __call__(self):
+        second = int(time.time())
+        if second != self.second:
+            self.second = second
+            self.string = time.strftime(self.fmt, time.localtime(second))
+        return self.string
+
+timestamp = SecondClock()
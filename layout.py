@@ -1,4 +1,6 @@
+from collections import deque
 import json
+import queue
 import re
 import os
 
@@ -8,18 +10,325 @@ from tkinter import messagebox as tkmb
 from tkinter import simpledialog as tksd
 
 import pygubu
-from PIL import Image, ImageTk, ImageOps, ImageChops
+# PIL and the asset thread pool are imported where they are first needed,
+# so the window can come up before any image has to be decoded
 
+import layoutbin
+from layoutmodel import Layout, LayoutItem, load_layout
+
+
+class ImageAsset():
+    def __init__(self, image):
+        self.image = image
+        self.c_image = None
+        self.c_select_image = None
+
+    def photo(self):
+        if not self.c_image:
+            from PIL import ImageTk
+            self.c_image = ImageTk.PhotoImage(self.image)
+        return self.c_image
+
+    def select_photo(self):
+        # most objects are never selected, so the tinted copy is made on demand
+        if not self.c_select_image:
+            from PIL import Image, ImageChops, ImageTk
+            select_image = ImageChops.blend(self.image, Image.new('RGBA', self.image.size, (0x00, 0x00, 0xff, 0xff)), 0x44/0xff)
+            self.c_select_image = ImageTk.PhotoImage(select_image)
+        return self.c_select_image
+
+def decode_asset(path):
+    from PIL import Image
+    mtime = os.path.getmtime(path)
+    return mtime, Image.open(path).convert("RGBA")
+
+BLANK_ASSET = None
+
+def blank_asset():
+    # placeholder for objects without a (loaded) image, made on first use
+    global BLANK_ASSET
+    if not BLANK_ASSET:
+        from PIL import Image
+        BLANK_ASSET = ImageAsset(Image.new("RGBA", (32, 32), (0xaa, 0xaa, 0xaa, 0xff)))
+    return BLANK_ASSET
+
+class AssetCache():
+    def __init__(self, workers=4):
+        self.assets = {} # real path -> (mtime, asset)
+        self.loading = {} # real path -> callbacks waiting for it
+        self.done = queue.Queue()
+        self.workers = workers
+        self.pool = None # started with the first image load
+
+    def cached(self, path):
+        entry = self.assets.get(path)
+        if entry and entry[0] == os.path.getmtime(path):
+            return entry[1]
+        return None
+
+    def get(self, path):
+        path = os.path.realpath(path)
+        asset = self.cached(path)
+        if not asset:
+            mtime, image = decode_asset(path)
+            asset = ImageAsset(image)
+            self.assets[path] = (mtime, asset)
+        return asset
+
+    def get_async(self, path, callback):
+        # decoding happens on the pool, callbacks run from poll() on the
+        # Tk thread, which is also where the PhotoImages get created
+        path = os.path.realpath(path)
+        try:
+            asset = self.cached(path)
+        except OSError:
+            return
+        if asset:
+            callback(asset)
+        elif path in self.loading:
+            self.loading[path].append(callback)
+        else:
+            self.loading[path] = [callback]
+            if not self.pool:
+                from concurrent.futures import ThreadPoolExecutor
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            future = self.pool.submit(decode_asset, path)
+            future.add_done_callback(lambda future: self.done.put((path, future)))
+
+    def poll(self):
+        while True:
+            try:
+                path, future = self.done.get_nowait()
+            except queue.Empty:
+                break
+            callbacks = self.loading.pop(path, [])
+            try:
+                mtime, image = future.result()
+            except OSError:
+                continue # leave the placeholder up
+            asset = ImageAsset(image)
+            self.assets[path] = (mtime, asset)
+            for callback in callbacks:
+                callback(asset)
+        return len(self.loading) > 0
+
+    def stale(self, paths):
+        # files that aren't cached as they are on disk now: modified since
+        # they were decoded, or missing before and created since. deleted
+        # ones keep their last good image
+        stale = []
+        for path in set(os.path.realpath(path) for path in paths):
+            if path in self.loading:
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            entry = self.assets.get(path)
+            if not entry or entry[0] != mtime:
+                stale.append(path)
+        return stale
+
+    def retain(self, paths):
+        paths = set(os.path.realpath(path) for path in paths)
+        for path in list(self.assets):
+            if path not in paths:
+                del self.assets[path]
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+class SpatialGrid():
+    # uniform grid over layout coordinates, boxes are (x0, y0, x1, y1)
+    def __init__(self, cell=32):
+        self.cell = cell
+        self.cells = {}
+        self.boxes = {}
+
+    def cell_keys(self, box):
+        x0, y0, x1, y1 = box
+        c = self.cell
+        for cx in range(int(x0 // c), int(x1 // c) + 1):
+            for cy in range(int(y0 // c), int(y1 // c) + 1):
+                yield (cx, cy)
+
+    def insert(self, obj, box):
+        self.boxes[obj] = box
+        for key in self.cell_keys(box):
+            self.cells.setdefault(key, set()).add(obj)
+
+    def remove(self, obj):
+        box = self.boxes.pop(obj, None)
+        if box is None:
+            return
+        for key in self.cell_keys(box):
+            cell = self.cells.get(key)
+            if cell:
+                cell.discard(obj)
+                if not cell:
+                    del self.cells[key]
+
+    def update(self, obj, box):
+        if self.boxes.get(obj) == box:
+            return
+        self.remove(obj)
+        self.insert(obj, box)
+
+    def candidates(self, box):
+        found = set()
+        for key in self.cell_keys(box):
+            found.update(self.cells.get(key, ()))
+        return found
+
+    def query(self, box):
+        x0, y0, x1, y1 = box
+        hits = []
+        for obj in self.candidates(box):
+            bx0, by0, bx1, by1 = self.boxes[obj]
+            if bx0 < x1 and x0 < bx1 and by0 < y1 and y0 < by1:
+                hits.append(obj)
+        return hits
+
+    def query_point(self, x, y):
+        return self.query((x, y, x + 1, y + 1))
+
+    def contained(self, box):
+        x0, y0, x1, y1 = box
+        hits = []
+        for obj in self.candidates(box):
+            bx0, by0, bx1, by1 = self.boxes[obj]
+            if x0 <= bx0 and y0 <= by0 and bx1 <= x1 and by1 <= y1:
+                hits.append(obj)
+        return hits
+
+    def snap(self, obj, x, y, distance):
+        # pull the edges of obj at (x, y) onto nearby edges of other objects
+        w = obj.w
+        h = obj.h
+        best_x = best_y = None
+        near = (x - distance, y - distance, x + w + distance, y + h + distance)
+        for other in self.candidates(near):
+            if other is obj:
+                continue
+            ox0, oy0, ox1, oy1 = self.boxes[other]
+            for dx in (ox0 - x, ox1 - x, ox0 - (x + w), ox1 - (x + w)):
+                if abs(dx) <= distance and (best_x is None or abs(dx) < abs(best_x)):
+                    best_x = dx
+            for dy in (oy0 - y, oy1 - y, oy0 - (y + h), oy1 - (y + h)):
+                if abs(dy) <= distance and (best_y is None or abs(dy) < abs(best_y)):
+                    best_y = dy
+        return x + (best_x or 0), y + (best_y or 0)
+
+class EditChange():
+    # only the attributes an edit touched are kept, the values themselves
+    # (assets included) are shared with the live objects, not copied
+    def __init__(self, object, before, after, merge_key=None):
+        self.object = object
+        self.before = before
+        self.after = after
+        self.merge_key = merge_key
+
+    def merge(self, other):
+        for name, value in other.before.items():
+            self.before.setdefault(name, value)
+        self.after.update(other.after)
+
+    def undo(self, app):
+        app.apply_values(self.object, self.before)
+        app.focus_object(self.object)
+
+    def redo(self, app):
+        app.apply_values(self.object, self.after)
+        app.focus_object(self.object)
+
+class EditSwap():
+    merge_key = None
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def undo(self, app):
+        app.swap_objects(self.a, self.b)
+        app.focus_object(app.selected_object)
+
+    redo = undo
+
+class EditInsert():
+    merge_key = None
+
+    def __init__(self, index, object):
+        self.index = index
+        self.object = object
+
+    def undo(self, app):
+        app.remove_object(self.object)
+        app.focus_object(None)
+
+    def redo(self, app):
+        app.insert_object(self.index, self.object)
+        app.focus_object(self.object)
+
+class EditDelete(EditInsert):
+    undo = EditInsert.redo
+    redo = EditInsert.undo
+
+class History():
+    # bounded, the oldest edits fall off the end once depth is reached
+    def __init__(self, depth=100):
+        self.undo_stack = deque(maxlen=depth)
+        self.redo_stack = []
+
+    def push(self, action):
+        top = self.undo_stack[-1] if self.undo_stack else None
+        if top and action.merge_key is not None and top.merge_key == action.merge_key:
+            top.merge(action)
+        else:
+            self.undo_stack.append(action)
+        self.redo_stack.clear()
+
+    def undo(self, app):
+        if not self.undo_stack:
+            return False
+        action = self.undo_stack.pop()
+        action.undo(app)
+        self.redo_stack.append(action)
+        return True
+
+    def redo(self, app):
+        if not self.redo_stack:
+            return False
+        action = self.redo_stack.pop()
+        action.redo(app)
+        self.undo_stack.append(action)
+        return True
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+
+def item_property(name):
+    return property(
+        lambda self: getattr(self.item, name),
+        lambda self, value: setattr(self.item, name, value)
+    )
 
 class LayoutObject():
-    def __init__(self, id):
-        self.x = 0
-        self.y = 0
+    # editor view of a layoutmodel.LayoutItem, the layout data lives on
+    # the item and only canvas, tree and drag state is kept here
+    __slots__ = ("item", "w", "h", "canvas_id", "tree_id", "selected", "drag_offset")
+
+    id = item_property("id")
+    x = item_property("x")
+    y = item_property("y")
+    variant = item_property("variant")
+    enabled = item_property("enabled")
+
+    def __init__(self, id, item=None):
+        self.item = item if item is not None else LayoutItem(type(self).__name__, id)
         self.w = 0
         self.h = 0
-        self.variant = "default"
-        self.enabled = True
-        self.id = id
         self.canvas_id = None
         self.tree_id = None
         self.selected = False
@@ -28,6 +337,9 @@ class LayoutObject():
     def draw(self, canvas):
         pass
 
+    def box(self):
+        return (self.x, self.y, self.x + self.w, self.y + self.h)
+
     def set_props(self, components):
         for name, object in components.items():
             if name == "id":
@@ -52,27 +364,30 @@ class LayoutObject():
                 object.set(self.y)
 
 class ObjectImage(LayoutObject):
-    BLANK_IMAGE = Image.new("RGBA", (32, 32), (0xaa, 0xaa, 0xaa, 0xff))
-
-    def __init__(self, id, image):
-        super().__init__(id)
-        self.image_path = ""
-        self.image_real_path = ""
-        self.set_image(image)
+    __slots__ = ("image_real_path", "asset")
 
-    def set_image(self, image):
-        self.image = image
-        self.select_image = ImageChops.blend(image, Image.new('RGBA', image.size, (0x00, 0x00, 0xff, 0xff)), 0x44/0xff)
+    image_path = item_property("image")
 
-        self.c_image = ImageTk.PhotoImage(self.image)
-        self.c_select_image = ImageTk.PhotoImage(self.select_image)
+    def __init__(self, id, asset, item=None):
+        super().__init__(id, item)
+        self.image_real_path = ""
+        self.set_image(asset)
 
-        self.w = image.width
-        self.h = image.height
+    def set_image(self, asset):
+        # assets are shared between every object using the same file
+        self.asset = asset
+        self.w = asset.image.width
+        self.h = asset.image.height
 
     def draw(self, canvas):
-        # print(f"draw({self.id}, {self.x}, {self.y}, {self.w}, {self.h})")
-        self.canvas_id = canvas.create_image(self.x+1, self.y+1, image=self.c_image if not self.selected else self.c_select_image, anchor=tk.NW)
+        # the canvas item is created once and then updated in place
+        image = self.asset.photo() if not self.selected else self.asset.select_photo()
+        state = tk.NORMAL if self.enabled else tk.HIDDEN
+        if self.canvas_id is None:
+            self.canvas_id = canvas.create_image(self.x+1, self.y+1, image=image, anchor=tk.NW, state=state)
+        else:
+            canvas.coords(self.canvas_id, self.x+1, self.y+1)
+            canvas.itemconfigure(self.canvas_id, image=image, state=state)
 
     def set_props(self, components):
         super().set_props(components)
@@ -85,13 +400,18 @@ class ObjectImage(LayoutObject):
                 object.insert(0, self.image_path)
                 object.state(["disabled"])
 
-    def refresh_image(self):
-        self.set_image(Image.open(self.image_real_path))
+    def refresh_image(self, assets):
+        self.set_image(assets.get(self.image_real_path))
 
 class ObjectButton(ObjectImage):
-    def __init__(self, id, image, tint):
-        super().__init__(id, image)
-        self.tint = tint
+    __slots__ = ()
+
+    tint = item_property("tint")
+
+    def __init__(self, id, asset, tint=None, item=None):
+        super().__init__(id, asset, item)
+        if item is None:
+            self.tint = tint
 
     def set_props(self, components):
         super().set_props(components)
@@ -103,7 +423,17 @@ class ObjectButton(ObjectImage):
             elif name == "tint_preview":
                 object.config(bg=self.tint)
 
+VIEWS = {
+    "ObjectImage": ObjectImage,
+    "ObjectButton": ObjectButton,
+}
+
 class LayoutApp():
+    DRAG_INTERVAL = 16 # ms, about one frame
+    ASSET_POLL_INTERVAL = 20
+    WATCH_INTERVAL = 1000
+    SNAP_DISTANCE = 4
+
     def __init__(self):
         self.builder = pygubu.Builder()
         self.builder.add_from_file("layout.ui")
@@ -112,19 +442,36 @@ class LayoutApp():
         self.menu = self.builder.get_object("menu")
         self.mainwindow["menu"] = self.menu
 
-        self.prop_dialog = self.builder.get_object("properties_dialog")
-        self.prop_dialog.parent = self.mainwindow
+        # the properties dialog is only built when it is first opened, from
+        # its own builder so connecting its callbacks leaves the main
+        # window's alone
+        self.prop_builder = None
+        self.prop_dialog = None
 
         self.builder.connect_callbacks(self)
 
         self.mainwindow.bind("<Delete>", self.edit_delete_callback)
         self.mainwindow.bind("<Control-s>", self.save_callback)
+        self.mainwindow.bind("<Control-z>", self.edit_undo_callback)
+        self.mainwindow.bind("<Control-y>", self.edit_redo_callback)
+        self.mainwindow.bind("<Control-Z>", self.edit_redo_callback)
         self.mainwindow.protocol("WM_DELETE_WINDOW", self.quit_callback)
 
         self.object_tree = self.builder.get_object("object_tree")
         self.canvas = self.builder.get_object("layout_canvas")
+        self.canvas.bind("<B3-Motion>", self.canvas_box_drag)
+        self.canvas.bind("<ButtonRelease-3>", self.canvas_box_release)
+        self.canvas.bind("<ButtonRelease-1>", self.canvas_release)
 
         self.objects = []
+        self.assets = AssetCache()
+        self.grid = SpatialGrid()
+        self.by_canvas = {}
+        self.by_tree = {}
+        self.z_order = {}
+        self.box_start = None
+        self.box_item = None
+        self.drag_start = None
         self.width = 256
         self.height = 384
 
@@ -148,11 +495,20 @@ class LayoutApp():
         ]
 
         self.selected_object = None
+        self.drag_job = None
+        self.asset_job = None
+        self.watch_job = None
 
         self.the_file = None
 
         self.img_root = None
+        self.history_depth = 100
+        self.watch_assets = False
         self.load_conf()
+        self.history = History(self.history_depth)
+        self.builder.get_variable("watch_assets_var").set(self.watch_assets)
+        if self.watch_assets:
+            self.watch_poll()
 
         self.refresh_canvas()
         self.refresh_props()
@@ -166,6 +522,8 @@ class LayoutApp():
         with open("layout.conf", "w") as f:
             json_o = {
                 "img_root": self.img_root,
+                "history_depth": self.history_depth,
+                "watch_assets": self.watch_assets,
             }
             f.write(json.dumps(json_o))
 
@@ -174,96 +532,108 @@ class LayoutApp():
             with open("layout.conf", "r") as f:
                 json_f = json.loads(f.read())
             self.img_root = json_f["img_root"]
+            self.history_depth = json_f.get("history_depth", self.history_depth)
+            self.watch_assets = json_f.get("watch_assets", self.watch_assets)
+
+    def to_layout(self, objects):
+        return Layout(self.width, self.height, [obj.item for obj in objects])
+
+    def from_layout(self, layout):
+        # views start with the placeholder image, see load_assets()
+        objects = []
+        for item in layout.objects:
+            obj = VIEWS[item.type](item.id, blank_asset(), item=item)
+            obj.image_real_path = self.img_root + "/" + item.image
+            objects.append(obj)
+
+        self.width = layout.width
+        self.height = layout.height
 
-    def serialize(self, objects):
-        json_out = {}
-
-        json_out["objects"] = []
-        json_out["w"] = self.width
-        json_out["h"] = self.height
-
-        for obj in objects:
-            json_obj = {}
-
-            json_obj["type"] = type(obj).__name__
-            json_obj["id"] = obj.id
-            json_obj["variant"] = obj.variant
-            json_obj["enabled"] = obj.enabled
-            json_obj["x"] = obj.x
-            json_obj["y"] = obj.y
-
-            if type(obj) == ObjectImage:
-                json_obj["props"] = {
-                    "image": obj.image_path
-                }
-            elif type(obj) == ObjectButton:
-                json_obj["props"] = {
-                    "image": obj.image_path,
-                    "tint": obj.tint
-                }
-
-            json_out["objects"].append(json_obj)
-
-        return json.dumps(json_out)
-
-    def deserialize(self, string):
-        json_in = json.loads(string)
-        resolved_out = []
-
-        for json_obj in json_in["objects"]:
-            type =  json_obj["type"]
-            obj = None
-
-            if type == "ObjectImage":
-                path = self.img_root + "/" + json_obj["props"]["image"]
-                img = Image.open(path) if json_obj["props"]["image"] else ObjectImage.BLANK_IMAGE
-                obj = ObjectImage(json_obj["id"], img)
-                obj.image_path = json_obj["props"]["image"]
-                obj.image_real_path = path
-            elif type == "ObjectButton":
-                path = self.img_root + "/" + json_obj["props"]["image"]
-                img = Image.open(path) if json_obj["props"]["image"] else ObjectImage.BLANK_IMAGE
-                obj = ObjectButton(json_obj["id"], img, json_obj["props"]["tint"])
-                obj.image_path = json_obj["props"]["image"]
-                obj.image_real_path = path
-
-            obj.variant = json_obj["variant"]
-            obj.enabled = json_obj["enabled"]
-            obj.x = json_obj["x"]
-            obj.y = json_obj["y"]
-            resolved_out.append(obj)
-
-        self.width = json_in["w"]
-        self.height = json_in["h"]
-
-        return resolved_out
+        return objects
 
     def validate_number(self, newtext):
         return re.match(r"^[0-9]*$", newtext) != None
 
     def open_callback(self):
         select = tkfd.askopenfilename(
-            filetypes=(("layout files", "*.layout"),("all files","*.*"))
+            filetypes=(("layout files", "*.layout"),("binary layout files", "*.layoutb"),("all files","*.*"))
         )
         if select:
             self.the_file = select
-            with open(self.the_file, "r") as f:
-                self.objects = self.deserialize(f.read())
+            for obj in self.objects:
+                obj.canvas_id = None
+            self.canvas.delete(tk.ALL)
+            self.objects = self.from_layout(load_layout(self.the_file))
             self.selected_object = None
+            self.history.clear()
+            self.load_assets(self.objects)
             self.refresh_tree()
             self.refresh_canvas()
             self.refresh_props()
 
+    def load_assets(self, objects):
+        # objects start out with the placeholder image and get the real
+        # one swapped in as each file finishes decoding
+        images = [obj for obj in objects if isinstance(obj, ObjectImage) and obj.image_path]
+        self.assets.retain(obj.image_real_path for obj in images)
+        for obj in images:
+            self.assets.get_async(obj.image_real_path, lambda asset, obj=obj, path=obj.image_real_path: self.asset_loaded(obj, asset, path))
+        if not self.asset_job:
+            self.poll_assets()
+
+    def asset_loaded(self, obj, asset, path):
+        # a slow load can finish after another image was picked for obj
+        if obj.image_real_path != path:
+            return
+        obj.set_image(asset)
+        if obj.canvas_id is not None:
+            self.redraw_object(obj)
+
+    def poll_assets(self):
+        self.asset_job = None
+        if self.assets.poll():
+            self.asset_job = self.mainwindow.after(self.ASSET_POLL_INTERVAL, self.poll_assets)
+
+    def watch_assets_callback(self):
+        self.watch_assets = self.builder.get_variable("watch_assets_var").get()
+        self.save_conf()
+        if self.watch_job:
+            self.mainwindow.after_cancel(self.watch_job)
+            self.watch_job = None
+        if self.watch_assets:
+            self.watch_poll()
+
+    def watch_poll(self):
+        # every image the layout uses is checked, not just the cached ones,
+        # so one that was missing at open shows up once it is created. a
+        # changed file is decoded again in the background and only the
+        # objects using it are redrawn; its old PhotoImages go with the
+        # replaced cache entry
+        self.watch_job = self.mainwindow.after(self.WATCH_INTERVAL, self.watch_poll)
+        changed = self.assets.stale(obj.image_real_path for obj in self.objects if isinstance(obj, ObjectImage) and obj.image_path)
+        for path in changed:
+            self.assets.get_async(path, lambda asset, path=path: self.asset_reloaded(path, asset))
+        if changed and not self.asset_job:
+            self.poll_assets()
+
+    def asset_reloaded(self, path, asset):
+        for obj in self.objects:
+            if isinstance(obj, ObjectImage) and obj.image_path and os.path.realpath(obj.image_real_path) == path:
+                self.asset_loaded(obj, asset, obj.image_real_path)
+
     def save_callback(self, event=None):
         if not self.the_file:
             return self.saveas_callback()
-        with open(self.the_file, "w") as f:
-            f.write(self.serialize(self.objects))
+        if self.the_file.endswith(".layoutb"):
+            layoutbin.write_layout(self.to_layout(self.objects), self.the_file)
+        else:
+            with open(self.the_file, "w") as f:
+                f.write(self.to_layout(self.objects).to_json())
         return True
 
     def saveas_callback(self):
         select = tkfd.asksaveasfilename(
-            filetypes=(("layout files", "*.layout"),("all files","*.*")),
+            filetypes=(("layout files", "*.layout"),("binary layout files", "*.layoutb"),("all files","*.*")),
             defaultextension=".layout",
             initialdir=self.img_root
         )
@@ -276,8 +646,10 @@ class LayoutApp():
         choice = tkmb.askyesnocancel("Quit", "Do you want to save your changes?")
         if choice == True:
             if self.save_callback():
+                self.assets.close()
                 self.mainwindow.quit()
         elif choice == False:
+            self.assets.close()
             self.mainwindow.quit()
         else:
             pass # choice == None
@@ -288,12 +660,10 @@ class LayoutApp():
             if isinstance(object, ObjectImage):
                 new_id += 1
 
-        new = ObjectImage(f"image_{new_id}", ObjectImage.BLANK_IMAGE)
-        self.objects.append(new)
-        self.selected_object = new
-        self.refresh_tree()
-        self.refresh_canvas()
-        self.refresh_props()
+        new = ObjectImage(f"image_{new_id}", blank_asset())
+        self.history.push(EditInsert(len(self.objects), new))
+        self.insert_object(len(self.objects), new)
+        self.focus_object(new)
 
     def new_button_callback(self):
         new_id = 0
@@ -301,28 +671,36 @@ class LayoutApp():
             if isinstance(object, ObjectButton):
                 new_id += 1
 
-        new = ObjectButton(f"button_{new_id}", ObjectImage.BLANK_IMAGE, "#ffffff")
-        self.objects.append(new)
-        self.selected_object = new
-        self.refresh_tree()
-        self.refresh_canvas()
-        self.refresh_props()
+        new = ObjectButton(f"button_{new_id}", blank_asset(), "#ffffff")
+        self.history.push(EditInsert(len(self.objects), new))
+        self.insert_object(len(self.objects), new)
+        self.focus_object(new)
 
     def new_text_callback(self):
         ...
 
+    def properties_dialog(self):
+        if not self.prop_dialog:
+            self.prop_builder = pygubu.Builder()
+            self.prop_builder.add_from_file("layout.ui")
+            self.prop_dialog = self.prop_builder.get_object("properties_dialog")
+            self.prop_dialog.parent = self.mainwindow
+            self.prop_builder.connect_callbacks(self)
+        return self.prop_dialog
+
     def menu_properties(self):
+        dialog = self.properties_dialog()
         if self.img_root:
-            object = self.builder.get_object("props_basedir_path")
+            object = self.prop_builder.get_object("props_basedir_path")
             object.state(["!readonly"])
             object.delete(0, tk.END)
             object.insert(0, self.img_root)
             object.state(["readonly"])
 
-        self.builder.get_variable("props_width_var").set(self.width)
-        self.builder.get_variable("props_height_var").set(self.height)
+        self.prop_builder.get_variable("props_width_var").set(self.width)
+        self.prop_builder.get_variable("props_height_var").set(self.height)
 
-        self.prop_dialog.show()
+        dialog.show()
 
     def props_close_callback(self):
         self.prop_dialog.close()
@@ -332,37 +710,51 @@ class LayoutApp():
         if select:
             self.img_root = select
             self.save_conf()
-            object = self.builder.get_object("props_basedir_path")
+            object = self.prop_builder.get_object("props_basedir_path")
             object.state(["!readonly"])
             object.delete(0, tk.END)
             object.insert(0, select)
             object.state(["readonly"])
 
     def props_width_callback(self, event):
-        self.width = self.builder.get_variable("props_width_var").get()
+        self.width = self.prop_builder.get_variable("props_width_var").get()
         self.canvas.configure(width=self.width, height=self.height)
 
     def props_height_callback(self, event):
-        self.height = self.builder.get_variable("props_height_var").get()
+        self.height = self.prop_builder.get_variable("props_height_var").get()
         self.canvas.configure(width=self.width, height=self.height)
 
     def get_selected_index(self):
-        for i, object in enumerate(self.objects):
-            if object == self.selected_object:
-                return i
-        return None
+        return self.z_order.get(self.selected_object)
+
+    def swap_objects(self, a, b):
+        if a == b:
+            return
+        a, b = min(a, b), max(a, b)
+        objects = self.objects
+        objects[a], objects[b] = objects[b], objects[a]
+        self.z_order[objects[a]] = a
+        self.z_order[objects[b]] = b
+
+        # move just the two tree rows and canvas items, lower one first
+        for idx in (a, b):
+            self.object_tree.move(objects[idx].tree_id, "", idx)
+            if objects[idx].canvas_id is None:
+                continue
+            if idx == 0:
+                self.canvas.tag_lower(objects[idx].canvas_id)
+            elif objects[idx - 1].canvas_id is not None:
+                self.canvas.tag_raise(objects[idx].canvas_id, objects[idx - 1].canvas_id)
+            else:
+                self.restack()
 
     def pos_up_callback(self):
         idx = self.get_selected_index()
         if idx == 0:
             return
 
-        tmp = self.objects[idx - 1]
-        self.objects[idx - 1] = self.objects[idx]
-        self.objects[idx] = tmp
-
-        self.refresh_tree()
-        self.refresh_canvas()
+        self.history.push(EditSwap(idx, idx - 1))
+        self.swap_objects(idx, idx - 1)
         self.refresh_props()
 
     def pos_down_callback(self):
@@ -370,12 +762,8 @@ class LayoutApp():
         if idx == len(self.objects) - 1:
             return
 
-        tmp = self.objects[idx + 1]
-        self.objects[idx + 1] = self.objects[idx]
-        self.objects[idx] = tmp
-
-        self.refresh_tree()
-        self.refresh_canvas()
+        self.history.push(EditSwap(idx, idx + 1))
+        self.swap_objects(idx, idx + 1)
         self.refresh_props()
 
     def pos_tofront_callback(self):
@@ -384,12 +772,8 @@ class LayoutApp():
         if idx == top:
             return
 
-        tmp = self.objects[top]
-        self.objects[top] = self.objects[idx]
-        self.objects[idx] = tmp
-
-        self.refresh_tree()
-        self.refresh_canvas()
+        self.history.push(EditSwap(idx, top))
+        self.swap_objects(idx, top)
         self.refresh_props()
 
     def pos_toback_callback(self):
@@ -397,12 +781,8 @@ class LayoutApp():
         if idx == 0:
             return
 
-        tmp = self.objects[0]
-        self.objects[0] = self.objects[idx]
-        self.objects[idx] = tmp
-
-        self.refresh_tree()
-        self.refresh_canvas()
+        self.history.push(EditSwap(idx, 0))
+        self.swap_objects(idx, 0)
         self.refresh_props()
 
     def edit_delete_callback(self, event=None):
@@ -413,27 +793,82 @@ class LayoutApp():
         resp = tkmb.askokcancel(f"Delete?", f"Delete {self.selected_object.id}?")
 
         if resp:
-            del self.objects[idx]
+            self.history.push(EditDelete(idx, self.selected_object))
+            self.remove_object(self.selected_object)
+            self.refresh_props()
+
+    def edit_undo_callback(self, event=None):
+        self.drag_flush()
+        self.history.undo(self)
+
+    def edit_redo_callback(self, event=None):
+        self.drag_flush()
+        self.history.redo(self)
+
+    def insert_object(self, idx, object):
+        self.objects.insert(idx, object)
+        self.reindex()
+        self.add_tree_item(object, idx)
+        self.redraw_object(object)
+        if idx < len(self.objects) - 1:
+            self.restack()
+
+    def remove_object(self, object):
+        if object is self.selected_object:
             self.selected_object = None
+        if object.canvas_id is not None:
+            self.canvas.delete(object.canvas_id)
+            self.by_canvas.pop(object.canvas_id, None)
+            object.canvas_id = None
+        self.grid.remove(object)
+        self.by_tree.pop(object.tree_id, None)
+        self.object_tree.delete(object.tree_id)
+        del self.objects[self.z_order[object]]
+        self.reindex()
+
+    def change_object(self, object, merge_key=None, **values):
+        before = {name: getattr(object, name) for name in values}
+        if before == values:
+            return
+        self.history.push(EditChange(object, before, values, merge_key))
+        self.apply_values(object, values)
 
-            self.refresh_tree()
-            self.refresh_canvas()
-            self.refresh_props()
+    def apply_values(self, object, values):
+        for name, value in values.items():
+            if name == "asset":
+                object.set_image(value)
+            else:
+                setattr(object, name, value)
+        self.redraw_object(object)
+        self.refresh_tree_item(object)
+        if object is self.selected_object:
+            object.set_props(self.properties)
+
+    def focus_object(self, object):
+        self.select_object(object)
+        self.sync_tree_selection()
+        self.refresh_props()
+
+    def object_at(self, x, y):
+        current = self.canvas.find_withtag(tk.CURRENT)
+        if current and current[0] in self.by_canvas:
+            return self.by_canvas[current[0]]
+        # canvas items are drawn one pixel in from the layout origin
+        hits = self.grid.query_point(x - 1, y - 1)
+        if not hits:
+            return None
+        return max(hits, key=self.z_order.get)
 
     def canvas_click(self, event):
-        items = self.canvas.find_overlapping(event.x, event.y, event.x, event.y)
-        if len(items) > 0:
-            id = items[-1]
-            for object in self.objects:
-                if object.canvas_id == id:
-                    break
-            self.selected_object = object
+        object = self.object_at(event.x, event.y)
+        if object:
+            self.select_object(object)
             object.drag_offset = (event.x - object.x, event.y - object.y)
-            self.refresh_tree()
+            self.drag_start = (object, object.x, object.y)
+            self.sync_tree_selection()
         else:
-            self.selected_object = None
-            self.refresh_tree()
-            self.refresh_canvas()
+            self.select_object(None)
+            self.sync_tree_selection()
             self.refresh_props()
 
     def canvas_drag(self, event):
@@ -468,22 +903,85 @@ class LayoutApp():
             if dirty:
                 self.mainwindow.event_generate("<Motion>", when="tail", x=x+ex, y=y+ey, warp=1)
 
-            self.selected_object.x = ex - self.selected_object.drag_offset[0]
-            self.selected_object.y = ey - self.selected_object.drag_offset[1]
-            self.refresh_canvas()
-            self.refresh_props()
+            nx = ex - self.selected_object.drag_offset[0]
+            ny = ey - self.selected_object.drag_offset[1]
+            if not event.state & 0x1: # hold shift to place freely
+                nx, ny = self.grid.snap(self.selected_object, nx, ny, self.SNAP_DISTANCE)
+            self.selected_object.x = nx
+            self.selected_object.y = ny
+            # motion events come in faster than the screen refreshes, only
+            # the latest position is drawn once per DRAG_INTERVAL
+            if not self.drag_job:
+                self.drag_job = self.mainwindow.after(self.DRAG_INTERVAL, self.drag_flush)
+
+    def drag_flush(self):
+        if self.drag_job:
+            self.mainwindow.after_cancel(self.drag_job)
+        self.drag_job = None
+        if self.selected_object:
+            self.redraw_object(self.selected_object)
+            self.properties["x"].set(self.selected_object.x)
+            self.properties["y"].set(self.selected_object.y)
+
+    def canvas_release(self, event):
+        # a whole drag is one undo step
+        if not self.drag_start:
+            return
+        object, x, y = self.drag_start
+        self.drag_start = None
+        if (object.x, object.y) != (x, y):
+            self.history.push(EditChange(object, {"x": x, "y": y}, {"x": object.x, "y": object.y}))
 
     def canvas_right_click(self, event):
-        self.selected_object = None
-        self.refresh_tree()
-        self.refresh_canvas()
+        self.select_object(None)
+        self.sync_tree_selection()
         self.refresh_props()
+        self.box_start = (event.x, event.y)
+
+    def canvas_box_drag(self, event):
+        if not self.box_start:
+            return
+        x0, y0 = self.box_start
+        if self.box_item is None:
+            self.box_item = self.canvas.create_rectangle(x0, y0, event.x, event.y, outline="#0000ff", dash=(2, 2))
+        else:
+            self.canvas.coords(self.box_item, x0, y0, event.x, event.y)
+
+    def canvas_box_release(self, event):
+        # right-drag selects the topmost object lying fully inside the box
+        if self.box_item is not None:
+            x0, y0 = self.box_start
+            box = (min(x0, event.x) - 1, min(y0, event.y) - 1, max(x0, event.x) - 1, max(y0, event.y) - 1)
+            self.canvas.delete(self.box_item)
+            self.box_item = None
+            hits = self.grid.contained(box)
+            if hits:
+                self.select_object(max(hits, key=self.z_order.get))
+                self.sync_tree_selection()
+                self.refresh_props()
+        self.box_start = None
+
+    def reindex(self):
+        self.z_order = {object: i for i, object in enumerate(self.objects)}
+
+    def tree_values(self, object):
+        return (type(object).__name__, object.variant, object.enabled)
+
+    def add_tree_item(self, object, index="end"):
+        object.tree_id = self.object_tree.insert("", index, text=object.id, values=self.tree_values(object))
+        self.by_tree[object.tree_id] = object
+
+    def refresh_tree_item(self, object):
+        self.object_tree.item(object.tree_id, text=object.id, values=self.tree_values(object))
 
     def refresh_tree(self):
         self.object_tree.delete(*self.object_tree.get_children())
+        self.by_tree = {}
         for object in self.objects:
-            object.tree_id = self.object_tree.insert("", "end", text=object.id, values=(type(object).__name__, object.variant, object.enabled))
+            self.add_tree_item(object)
+        self.sync_tree_selection()
 
+    def sync_tree_selection(self):
         if self.selected_object:
             self.object_tree.focus(self.selected_object.tree_id)
             self.object_tree.selection_set(self.selected_object.tree_id)
@@ -492,18 +990,42 @@ class LayoutApp():
                 self.object_tree.selection_remove(self.object_tree.selection()[0])
 
     def refresh_canvas(self):
+        # full resync after the object list is replaced, single edits
+        # go through redraw_object() and restack()
+        self.reindex()
+        self.grid = SpatialGrid()
+        self.by_canvas = {}
+        live = set()
         for object in self.objects:
-            object.selected = False
-        if self.selected_object:
-            if self.selected_object.enabled:
-                self.selected_object.selected = True
-
-        canvas = self.canvas
-        canvas.delete(tk.ALL)
+            self.redraw_object(object)
+            live.add(object.canvas_id)
+        for item in self.canvas.find_all():
+            if item not in live:
+                self.canvas.delete(item)
+        self.restack()
+
+    def redraw_object(self, object):
+        object.selected = object is self.selected_object and object.enabled
+        object.draw(self.canvas)
+        if object.canvas_id is not None:
+            self.by_canvas[object.canvas_id] = object
+        if object.enabled:
+            self.grid.update(object, object.box())
+        else:
+            self.grid.remove(object)
 
+    def restack(self):
         for object in self.objects:
-            if object.enabled:
-                object.draw(canvas)
+            if object.canvas_id is not None:
+                self.canvas.tag_raise(object.canvas_id)
+
+    def select_object(self, object):
+        old = self.selected_object
+        self.selected_object = object
+        if old and old is not object:
+            self.redraw_object(old)
+        if object:
+            self.redraw_object(object)
 
     def refresh_props(self):
         for name, prop in self.properties.items():
@@ -526,55 +1048,44 @@ class LayoutApp():
 
     def id_unfocus_callback(self, event):
         if self.selected_object:
-            self.selected_object.id = self.builder.get_variable("prop_id_var").get()
-            self.refresh_tree()
-            self.refresh_canvas()
-            self.selected_object.set_props(self.properties)
+            self.change_object(self.selected_object, id=self.builder.get_variable("prop_id_var").get())
 
     def tint_unfocus_callback(self, event):
         if self.selected_object:
             new_tint = self.builder.get_variable("prop_tint_var").get()
             if re.match("^#[0-9A-Fa-f]{6}$", new_tint):
-                self.selected_object.tint = new_tint
-                self.selected_object.set_props(self.properties)
+                self.change_object(self.selected_object, tint=new_tint)
 
     def variant_unfocus_callback(self, event):
         if self.selected_object:
             new_variant = self.builder.get_variable("prop_variant_var").get().strip()
             new_variant = re.sub("[^A-Za-z0-9-_]", "", new_variant)
-            if new_variant:
-                self.selected_object.variant = new_variant
-            else:
-                self.selected_object.variant = "default"
+            self.change_object(self.selected_object, variant=new_variant or "default")
             self.selected_object.set_props(self.properties)
-            self.refresh_tree()
 
     def prop_enabled_callback(self):
         if self.selected_object:
-            self.selected_object.enabled = self.builder.get_variable("prop_enabled_var").get()
-            self.selected_object.set_props(self.properties)
-            self.refresh_tree()
+            self.change_object(self.selected_object, enabled=self.builder.get_variable("prop_enabled_var").get())
 
     def x_change_callback(self):
-        self.selected_object.x = self.builder.get_variable("prop_x_var").get()
-        self.refresh_canvas()
-        self.selected_object.set_props(self.properties)
+        # spinbox clicks in a row collapse into one undo step
+        self.change_object(self.selected_object, ("position", self.selected_object), x=self.builder.get_variable("prop_x_var").get())
 
     def y_change_callback(self):
-        self.selected_object.y = self.builder.get_variable("prop_y_var").get()
-        self.refresh_canvas()
-        self.selected_object.set_props(self.properties)
+        # spinbox clicks in a row collapse into one undo step
+        self.change_object(self.selected_object, ("position", self.selected_object), y=self.builder.get_variable("prop_y_var").get())
 
     def image_select_callback(self):
         selection = tkfd.askopenfilename(filetypes=(("png files", "*.png"),("all files","*.*")), initialdir=self.img_root)
         if len(selection) > 0:
             if not selection.startswith(self.img_root):
                 tkmb.showerror("Invalid Path", f"Selected file '{selection}' invalid (not child of image root)")
-            self.selected_object.image_path = selection[len(self.img_root) + 1:]
-            self.selected_object.image_real_path = selection
-            self.selected_object.refresh_image()
-            self.selected_object.set_props(self.properties)
-            self.refresh_canvas()
+            self.change_object(
+                self.selected_object,
+                image_path=selection[len(self.img_root) + 1:],
+                image_real_path=selection,
+                asset=self.assets.get(selection)
+            )
 
     def tree_select_callback(self, something):
         tree = self.object_tree
@@ -582,12 +1093,11 @@ class LayoutApp():
         if len(tree.selection()) == 0:
             return
 
-        for object in self.objects:
-            if object.tree_id == tree.selection()[0]:
-                break
+        object = self.by_tree.get(tree.selection()[0])
+        if not object:
+            return
 
-        self.selected_object = object
-        self.refresh_canvas()
+        self.select_object(object)
         self.refresh_props()
 
 
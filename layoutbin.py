@@ -0,0 +1,157 @@
+import mmap
+import struct
+import sys
+
+from layoutmodel import Layout, LayoutItem
+
+# file layout, all little-endian:
+#   header   MAGIC, version, width, height, counts and section offsets
+#   strings  u32 offsets[count + 1], then the utf-8 blob they index
+#   assets   u32 string id per referenced image path
+#   records  one fixed-size RECORD per object, in z-order
+MAGIC = b"PCLY"
+VERSION = 1
+HEADER = struct.Struct("<4sHHiiIIIIII")
+RECORD = struct.Struct("<BBHiiIIII")
+NONE = 0xffffffff
+TYPES = ("ObjectImage", "ObjectButton")
+
+class StringTable():
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def add(self, string):
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
+
+    def pack(self):
+        blob = [s.encode() for s in self.strings]
+        offsets = [0]
+        for data in blob:
+            offsets.append(offsets[-1] + len(data))
+        return struct.pack(f"<{len(offsets)}I", *offsets) + b"".join(blob)
+
+def dump_layout(layout):
+    strings = StringTable()
+    assets = []
+    asset_ids = {}
+    records = []
+
+    for item in layout.objects:
+        if item.type not in TYPES:
+            raise ValueError(f"{item.id}: unsupported object type {item.type!r}")
+        if type(item.x) is not int or type(item.y) is not int:
+            raise ValueError(f"{item.id}: position ({item.x!r}, {item.y!r}) is not integer")
+        image = NONE
+        if item.image:
+            if item.image not in asset_ids:
+                asset_ids[item.image] = len(assets)
+                assets.append(strings.add(item.image))
+            image = asset_ids[item.image]
+        tint = strings.add(item.tint) if item.tint is not None else NONE
+        records.append(RECORD.pack(
+            TYPES.index(item.type), 1 if item.enabled else 0, 0,
+            item.x, item.y,
+            strings.add(item.id), strings.add(item.variant), image, tint
+        ))
+
+    string_data = strings.pack()
+    asset_data = struct.pack(f"<{len(assets)}I", *assets)
+    strings_at = HEADER.size
+    assets_at = strings_at + len(string_data)
+    records_at = assets_at + len(asset_data)
+    header = HEADER.pack(
+        MAGIC, VERSION, 0, layout.width, layout.height,
+        len(records), len(strings.strings), len(assets),
+        strings_at, assets_at, records_at
+    )
+    return header + string_data + asset_data + b"".join(records)
+
+def write_layout(layout, path):
+    with open(path, "wb") as f:
+        f.write(dump_layout(layout))
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class BinaryLayout():
+    # reads records and strings straight out of the mapped file on demand
+    def __init__(self, data):
+        (magic, version, _, self.width, self.height,
+         self.count, self.string_count, self.asset_count,
+         self.strings_at, self.assets_at, self.records_at) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("not a binary layout")
+        if version != VERSION:
+            raise ValueError(f"unsupported binary layout version {version}")
+        self.data = data
+        self.blob_at = self.strings_at + 4 * (self.string_count + 1)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def string(self, i):
+        start, end = struct.unpack_from("<II", self.data, self.strings_at + 4 * i)
+        return bytes(self.data[self.blob_at + start:self.blob_at + end]).decode()
+
+    def asset(self, i):
+        return self.string(struct.unpack_from("<I", self.data, self.assets_at + 4 * i)[0])
+
+    def assets(self):
+        return [self.asset(i) for i in range(self.asset_count)]
+
+    def record(self, i):
+        # (type, enabled, x, y, id string, variant string, asset, tint string)
+        type, enabled, _, x, y, id, variant, image, tint = RECORD.unpack_from(self.data, self.records_at + RECORD.size * i)
+        return type, enabled, x, y, id, variant, image, tint
+
+    def item(self, i):
+        type, enabled, x, y, id, variant, image, tint = self.record(i)
+        item = LayoutItem(TYPES[type], self.string(id))
+        item.enabled = bool(enabled)
+        item.x = x
+        item.y = y
+        item.variant = self.string(variant)
+        item.image = self.asset(image) if image != NONE else ""
+        item.tint = self.string(tint) if tint != NONE else None
+        return item
+
+    def to_layout(self):
+        return Layout(self.width, self.height, [self.item(i) for i in range(self.count)])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(f"usage: {sys.argv[0]} <in> <out>  (converts .layout <-> .layoutb by content)")
+        sys.exit(1)
+
+    src, dst = sys.argv[1:]
+    if is_binary(src):
+        binary = BinaryLayout.open(src)
+        with open(dst, "w") as f:
+            f.write(binary.to_layout().to_json())
+        binary.close()
+    else:
+        with open(src, "r") as f:
+            json_string = f.read()
+        layout = Layout.from_json(json_string)
+        data = dump_layout(layout)
+        # refuse to write anything that would not come back identical
+        if BinaryLayout(data).to_layout().to_json() != layout.to_json():
+            print(f"{src}: does not round-trip, not written")
+            sys.exit(1)
+        with open(dst, "wb") as f:
+            f.write(data)
@@ -0,0 +1,274 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from PIL import Image
+
+from layoutmodel import find_layouts, load_img_root, load_layout
+
+CACHE_FILE = "layoutcheck.cache"
+
+# the editor shows objects without a usable image as a 32x32 placeholder
+BLANK_SIZE = (32, 32)
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def image_info(path):
+    # runs in a worker process: content hash and dimensions of one image
+    digest = file_hash(path)
+    try:
+        with Image.open(path) as im:
+            return digest, list(im.size)
+    except OSError:
+        return digest, None
+
+class ImageSizes():
+    # dimensions are stored by content hash, so copies of the same image
+    # share an entry; the hash itself is only redone when a file's size
+    # or mtime changes. the cache lives in the image root by default
+    def __init__(self, img_root, cache_file=None):
+        self.img_root = img_root
+        self.cache_file = os.path.join(img_root, CACHE_FILE) if cache_file is None else cache_file
+        self.files = {} # real path -> [mtime, size, hash]
+        self.sizes = {} # hash -> [w, h]
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, "r") as f:
+                    cache = json.loads(f.read())
+                self.files = cache["files"]
+                self.sizes = cache["sizes"]
+            except (ValueError, KeyError):
+                pass
+
+    def lookup(self, images, pool):
+        # stat every image here, and hash the new or changed ones in the
+        # pool, each file once however many layouts use it
+        sizes = {}
+        stale = {}
+        for image in images:
+            path = os.path.realpath(os.path.join(self.img_root, image))
+            try:
+                st = os.stat(path)
+            except OSError:
+                sizes[image] = None
+                continue
+            entry = self.files.get(path)
+            if entry and entry[0] == st.st_mtime and entry[1] == st.st_size and entry[2] in self.sizes:
+                sizes[image] = tuple(self.sizes[entry[2]])
+            else:
+                stale.setdefault(path, (st, []))[1].append(image)
+
+        jobs = {path: pool.submit(image_info, path) for path in stale}
+        for path, job in jobs.items():
+            st, names = stale[path]
+            try:
+                digest, size = job.result()
+            except OSError:
+                size = None
+            else:
+                self.files[path] = [st.st_mtime, st.st_size, digest]
+                if size:
+                    self.sizes[digest] = size
+            for image in names:
+                sizes[image] = tuple(size) if size else None
+        return sizes
+
+    def save(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, "w") as f:
+                f.write(json.dumps({"files": self.files, "sizes": self.sizes}))
+        except OSError:
+            # e.g. a read-only image root, the next run hashes again
+            pass
+
+def shown(item, variant, sizes):
+    # what layoutrender draws: enabled, in this variant or "default", and
+    # with an image that loads
+    return item.enabled and item.variant in ("default", variant) and sizes.get(item.image) is not None
+
+def find_overlaps(boxes):
+    # sweep along x: boxes are (x0, y0, x1, y1, item), sorted by x0, and
+    # only the ones still open at the sweep position are compared
+    boxes = sorted(boxes, key=lambda box: box[0])
+    active = []
+    pairs = []
+    for box in boxes:
+        x0, y0, x1, y1, item = box
+        active = [other for other in active if other[2] > x0]
+        for ox0, oy0, ox1, oy1, other in active:
+            if oy0 < y1 and y0 < oy1:
+                pairs.append((other, item))
+        active.append(box)
+    return pairs
+
+def check_layout(layout, sizes):
+    problems = []
+    def error(item, message):
+        problems.append(("error", item.id, message))
+    def warning(item, message):
+        problems.append(("warning", item.id, message))
+
+    seen = set()
+    for item in layout.objects:
+        if item.id in seen:
+            error(item, "duplicate id")
+        seen.add(item.id)
+
+    boxes = {}
+    for item in layout.objects:
+        if not item.image:
+            warning(item, "no image set")
+            size = BLANK_SIZE
+        elif sizes.get(item.image) is None:
+            error(item, f"missing image {item.image}")
+            size = BLANK_SIZE
+        else:
+            size = sizes[item.image]
+        box = (item.x, item.y, item.x + size[0], item.y + size[1])
+
+        if not item.enabled:
+            continue
+        if box[0] < 0 or box[1] < 0 or box[2] > layout.width or box[3] > layout.height:
+            error(item, f"outside the {layout.width}x{layout.height} canvas at {box}")
+        if item.type == "ObjectButton":
+            boxes[item] = box
+
+    # overlaps only matter between buttons drawn at the same time, so
+    # sweep each variant on its own; "default" pairs turn up in all of them
+    reported = set()
+    for variant in layout.variants():
+        buttons = [box + (item,) for item, box in boxes.items() if shown(item, variant, sizes)]
+        for a, b in find_overlaps(buttons):
+            if (a, b) not in reported:
+                reported.add((a, b))
+                error(b, f"overlaps button {a.id}")
+    return problems
+
+def check(paths, img_root, jobs=None, cache_file=None):
+    # returns {path: problems}, or {path: exception} for unreadable files
+    files = find_layouts(paths)
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        layouts = {}
+        for path, job in [(path, pool.submit(load_layout, path)) for path in files]:
+            try:
+                layouts[path] = job.result()
+            except (OSError, ValueError, KeyError) as e:
+                results[path] = e
+
+        # sizes are resolved once for all layouts and each worker gets the
+        # parsed layout back with only the sizes it uses
+        cache = ImageSizes(img_root, cache_file)
+        images = {image for layout in layouts.values() for image in layout.image_paths()}
+        sizes = cache.lookup(images, pool)
+        cache.save()
+
+        checks = {
+            path: pool.submit(check_layout, layout, {image: sizes[image] for image in layout.image_paths()})
+            for path, layout in layouts.items()
+        }
+        for path, job in checks.items():
+            try:
+                results[path] = job.result()
+            except (OSError, ValueError, KeyError) as e:
+                results[path] = e
+    return {path: results[path] for path in files}
+
+def match_items(layout):
+    # ids should be unique, but repeated ones are told apart by occurrence
+    keyed = {}
+    count = {}
+    for item in layout.objects:
+        n = count.get(item.id, 0)
+        count[item.id] = n + 1
+        keyed[(item.id, n)] = item
+    return keyed
+
+def key_name(key):
+    id, n = key
+    return id if not n else f"{id}#{n + 1}"
+
+def diff_layouts(old, new):
+    changes = []
+    if (old.width, old.height) != (new.width, new.height):
+        changes.append(f"~ size: {old.width}x{old.height} -> {new.width}x{new.height}")
+
+    old_items = match_items(old)
+    new_items = match_items(new)
+    for key in old_items:
+        if key not in new_items:
+            changes.append(f"- {key_name(key)}")
+    for key, item in new_items.items():
+        if key not in old_items:
+            changes.append(f"+ {key_name(key)}")
+            continue
+        old_json = old_items[key].to_json()
+        new_json = item.to_json()
+        fields = sorted(set(old_json) | set(new_json))
+        for field in fields:
+            if field == "props":
+                old_props = old_json.get("props", {})
+                new_props = new_json.get("props", {})
+                for prop in sorted(set(old_props) | set(new_props)):
+                    if old_props.get(prop) != new_props.get(prop):
+                        changes.append(f"~ {key_name(key)}: {prop} {old_props.get(prop)} -> {new_props.get(prop)}")
+            elif old_json.get(field) != new_json.get(field):
+                changes.append(f"~ {key_name(key)}: {field} {old_json.get(field)} -> {new_json.get(field)}")
+
+    old_order = [key for key in old_items if key in new_items]
+    new_order = [key for key in new_items if key in old_items]
+    if old_order != new_order:
+        changes.append("~ stacking order: " + ", ".join(key_name(key) for key in new_order))
+    return changes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="validate and diff .layout files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    check_parser = commands.add_parser("check", help="report overlapping buttons, off-canvas objects, duplicate ids and missing images")
+    check_parser.add_argument("paths", nargs="+", help="layout files or directories of layouts")
+    check_parser.add_argument("-i", "--img-root", default=None, help="image root (default: from layout.conf)")
+    check_parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    check_parser.add_argument("--cache", default=None, help=f"image size cache file, empty to disable (default: {CACHE_FILE} in the image root)")
+    check_parser.add_argument("-W", "--no-warnings", action="store_true", help="only print errors")
+
+    diff_parser = commands.add_parser("diff", help="show what changed between two layouts")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "diff":
+        changes = diff_layouts(load_layout(args.old), load_layout(args.new))
+        for line in changes:
+            print(line)
+        sys.exit(1 if changes else 0)
+
+    img_root = args.img_root or load_img_root()
+    if not img_root:
+        parser.error("no image root, pass --img-root or set it in the editor")
+
+    results = check(args.paths, img_root, args.jobs, args.cache)
+    failed = 0
+    for path, problems in results.items():
+        if isinstance(problems, Exception):
+            print(f"{path}: unreadable ({problems})")
+            failed += 1
+            continue
+        if any(level == "error" for level, _, _ in problems):
+            failed += 1
+        for level, id, message in problems:
+            if level == "error" or not args.no_warnings:
+                print(f"{path}: {level}: {id}: {message}")
+    print(f"{failed} of {len(results)} layouts failed", file=sys.stderr)
+    sys.exit(1 if failed else 0)
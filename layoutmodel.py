@@ -0,0 +1,110 @@
+import json
+import os
+
+
+class LayoutItem():
+    # plain layout data, no Tk or PIL state, so it is cheap to create in
+    # bulk and to pickle into worker processes
+    __slots__ = ("type", "id", "x", "y", "variant", "enabled", "image", "tint")
+
+    def __init__(self, type, id):
+        self.type = type
+        self.id = id
+        self.x = 0
+        self.y = 0
+        self.variant = "default"
+        self.enabled = True
+        self.image = ""
+        self.tint = None
+
+    @classmethod
+    def from_json(cls, json_obj):
+        item = cls(json_obj["type"], json_obj["id"])
+        item.variant = json_obj["variant"]
+        item.enabled = json_obj["enabled"]
+        item.x = json_obj["x"]
+        item.y = json_obj["y"]
+        props = json_obj.get("props", {})
+        item.image = props.get("image", "")
+        item.tint = props.get("tint")
+        return item
+
+    def to_json(self):
+        # key order is the one the editor has always written
+        json_obj = {
+            "type": self.type,
+            "id": self.id,
+            "variant": self.variant,
+            "enabled": self.enabled,
+            "x": self.x,
+            "y": self.y,
+        }
+        if self.type == "ObjectImage":
+            json_obj["props"] = {"image": self.image}
+        elif self.type == "ObjectButton":
+            json_obj["props"] = {"image": self.image, "tint": self.tint}
+        return json_obj
+
+class Layout():
+    __slots__ = ("width", "height", "objects")
+
+    def __init__(self, width=256, height=384, objects=None):
+        self.width = width
+        self.height = height
+        self.objects = objects if objects is not None else []
+
+    @classmethod
+    def from_json(cls, string):
+        json_in = json.loads(string)
+        objects = [LayoutItem.from_json(json_obj) for json_obj in json_in["objects"]]
+        return cls(json_in["w"], json_in["h"], objects)
+
+    def to_json(self):
+        return json.dumps({
+            "objects": [item.to_json() for item in self.objects],
+            "w": self.width,
+            "h": self.height,
+        })
+
+    def variants(self):
+        variants = ["default"]
+        for item in self.objects:
+            if item.variant not in variants:
+                variants.append(item.variant)
+        return variants
+
+    def image_paths(self):
+        paths = []
+        for item in self.objects:
+            if item.image and item.image not in paths:
+                paths.append(item.image)
+        return paths
+
+def load_layout(path):
+    # accepts both the json format and the binary one from layoutbin
+    import layoutbin
+    if layoutbin.is_binary(path):
+        binary = layoutbin.BinaryLayout.open(path)
+        layout = binary.to_layout()
+        binary.close()
+        return layout
+    with open(path, "r") as f:
+        return Layout.from_json(f.read())
+
+def find_layouts(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith((".layout", ".layoutb"))
+            )
+        else:
+            files.append(path)
+    return files
+
+def load_img_root(conf="layout.conf"):
+    # the editor keeps its image root in layout.conf
+    if os.path.exists(conf):
+        with open(conf, "r") as f:
+            return json.loads(f.read())["img_root"]
+    return None
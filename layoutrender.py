@@ -0,0 +1,126 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import sys
+
+from PIL import Image
+
+from layoutmodel import find_layouts, load_img_root, load_layout
+
+
+def load_images(layout, img_root):
+    images = {}
+    for path in layout.image_paths():
+        try:
+            images[path] = Image.open(os.path.join(img_root, path)).convert("RGBA")
+        except OSError as e:
+            print(f"warning: {path}: {e}", file=sys.stderr)
+    return images
+
+def render_variant(layout, variant, images):
+    # objects in "default" show up on every variant
+    out = Image.new("RGBA", (layout.width, layout.height), (0, 0, 0, 0))
+    for item in layout.objects:
+        if not item.enabled or item.variant not in ("default", variant):
+            continue
+        image = images.get(item.image)
+        if not image:
+            continue
+        layer = Image.new("RGBA", out.size, (0, 0, 0, 0))
+        layer.paste(image, (item.x, item.y))
+        out = Image.alpha_composite(out, layer)
+    return out
+
+def pack_atlas(images, max_width=1024, padding=1):
+    # shelf packing, tallest images first
+    order = sorted(images, key=lambda path: (-images[path].height, path))
+    width = max([max_width] + [image.width for image in images.values()])
+
+    frames = {}
+    x = y = shelf = used = 0
+    for path in order:
+        w, h = images[path].size
+        if x and x + w > width:
+            x = 0
+            y += shelf + padding
+            shelf = 0
+        frames[path] = [x, y, w, h]
+        x += w + padding
+        shelf = max(shelf, h)
+        used = max(used, x - padding)
+
+    atlas = Image.new("RGBA", (max(used, 1), max(y + shelf, 1)), (0, 0, 0, 0))
+    for path, (fx, fy, w, h) in frames.items():
+        atlas.paste(images[path], (fx, fy))
+    return atlas, frames
+
+def output_name(path):
+    # keeps the extension, a.layout and a.layoutb are different layouts
+    return os.path.basename(path)
+
+def compile_layout(path, img_root, out_dir, max_width=1024):
+    layout = load_layout(path)
+    images = load_images(layout, img_root)
+    name = output_name(path)
+
+    outputs = []
+    for variant in layout.variants():
+        filename = os.path.join(out_dir, f"{name}.{variant}.png")
+        render_variant(layout, variant, images).save(filename)
+        outputs.append(filename)
+
+    # "-atlas" rather than ".atlas": a variant could be called "atlas"
+    atlas, frames = pack_atlas(images, max_width)
+    atlas_file = os.path.join(out_dir, f"{name}-atlas.png")
+    atlas.save(atlas_file)
+
+    objects = []
+    for item in layout.objects:
+        json_obj = item.to_json()
+        if item.image in frames:
+            json_obj["frame"] = frames[item.image]
+        objects.append(json_obj)
+    manifest = {
+        "w": layout.width,
+        "h": layout.height,
+        "atlas": os.path.basename(atlas_file),
+        "frames": frames,
+        "objects": objects,
+    }
+    manifest_file = os.path.join(out_dir, f"{name}-atlas.json")
+    with open(manifest_file, "w") as f:
+        f.write(json.dumps(manifest))
+    return outputs + [atlas_file, manifest_file]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render .layout files and pack their images into an atlas")
+    parser.add_argument("paths", nargs="+", help="layout files or directories of layouts")
+    parser.add_argument("-i", "--img-root", default=None, help="image root (default: from layout.conf)")
+    parser.add_argument("-o", "--out", default="build", help="output directory")
+    parser.add_argument("-w", "--max-width", type=int, default=1024, help="atlas width limit")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    img_root = args.img_root or load_img_root()
+    if not img_root:
+        parser.error("no image root, pass --img-root or set it in the editor")
+
+    files = find_layouts(args.paths)
+    # every layout writes into the same output directory
+    seen = {}
+    for path in files:
+        other = seen.setdefault(output_name(path), path)
+        if other != path:
+            parser.error(f"{other} and {path} would overwrite each other's output in '{args.out}'")
+    files = list(seen.values())
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = [pool.submit(compile_layout, path, img_root, args.out, args.max_width) for path in files]
+        for path, job in zip(files, jobs):
+            try:
+                print(f"{path}: {len(job.result())} files")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"{path}: failed ({e})", file=sys.stderr)
@@ -0,0 +1,251 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import argparse
+import hashlib
+import json
+import math
+
+from logparse import TIME_FORMAT, expand_paths, iter_log, remote_str
+
+ROOMS = "ABCD"
+ROOM_LIMIT = 16 # server.join_room refuses joins past this
+
+def hash64(value):
+    # stable across worker processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+class HyperLogLog:
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        x = hash64(value)
+        j = x >> (64 - self.p)
+        w = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - w.bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        m = self.m
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            return round(m * math.log(m / zeros))
+        return round(estimate)
+
+class QuantileSketch:
+    # log-bucketed histogram with relative error alpha, mergeable by adding
+    # counts; the lowest buckets are collapsed if it grows past max_buckets
+    def __init__(self, alpha=0.01, max_buckets=2048):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets = Counter()
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        self.buckets[math.ceil(math.log(value) / self.log_gamma)] += 1
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        keys = sorted(self.buckets)
+        low = keys[len(keys) - self.max_buckets]
+        for key in keys[:len(keys) - self.max_buckets]:
+            self.buckets[low] += self.buckets.pop(key)
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.zeros += other.zeros
+        self.count += other.count
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+class TopK:
+    # space-saving heavy hitters, at most k counters
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = {}
+
+    def add(self, key, n=1):
+        if key in self.counts or len(self.counts) < self.k:
+            self.counts[key] = self.counts.get(key, 0) + n
+        else:
+            low = min(self.counts, key=self.counts.get)
+            self.counts[key] = self.counts.pop(low) + n
+
+    def merge(self, other):
+        for key, n in other.counts.items():
+            self.add(key, n)
+
+    def top(self, n=10):
+        return sorted(self.counts.items(), key=lambda kv: -kv[1])[:n]
+
+def parse_time(ts):
+    try:
+        return datetime.strptime(ts, TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+class LogStats:
+    def __init__(self):
+        self.files = 0
+        self.entries = 0
+        self.actions = Counter()
+        self.hourly = Counter()
+        self.users = HyperLogLog()
+        self.ips = HyperLogLog()
+        self.peak_connections = 0
+        self.peak_rooms = dict.fromkeys(ROOMS, 0)
+        self.aborts = TopK()
+        self.message_length = QuantileSketch()
+        self.session_length = QuantileSketch()
+
+    def feed_file(self, filename):
+        # one file is one server run, so connection and room state
+        # starts empty and only needs to live as long as the file
+        self.files += 1
+        connections = {}
+        rooms = {room: set() for room in ROOMS}
+
+        for item in iter_log(filename):
+            self.entries += 1
+            action = item.get("action")
+            if not action:
+                continue
+            self.actions[action] += 1
+            remote = remote_str(item.get("remote"))
+            ts = item.get("timestamp", "")
+
+            if action == "connect":
+                self.ips.add(remote.rsplit(":", 1)[0])
+                connections[remote] = parse_time(ts)
+                self.peak_connections = max(self.peak_connections, len(connections))
+            elif action in ("disconnect", "abort"):
+                start = connections.pop(remote, None)
+                end = parse_time(ts)
+                if start is not None and end is not None:
+                    self.session_length.add(end - start)
+                for members in rooms.values():
+                    members.discard(remote)
+                if action == "abort":
+                    self.aborts.add(remote.rsplit(":", 1)[0])
+            elif action == "username":
+                self.users.add(item.get("username", ""))
+            elif action == "join":
+                # the log has the join request, not the reply; a full room
+                # turns the request down, so it doesn't count
+                room = item.get("room")
+                if room in rooms and len(rooms[room]) < ROOM_LIMIT:
+                    rooms[room].add(remote)
+                    self.peak_rooms[room] = max(self.peak_rooms[room], len(rooms[room]))
+            elif action == "leave":
+                room = item.get("room")
+                if room in rooms:
+                    rooms[room].discard(remote)
+            elif action == "message":
+                self.hourly[ts[:13]] += 1
+                self.message_length.add(len(item.get("message", {}).get("data", "")))
+        return self
+
+    def merge(self, other):
+        self.files += other.files
+        self.entries += other.entries
+        self.actions.update(other.actions)
+        self.hourly.update(other.hourly)
+        self.users.merge(other.users)
+        self.ips.merge(other.ips)
+        self.peak_connections = max(self.peak_connections, other.peak_connections)
+        for room in ROOMS:
+            self.peak_rooms[room] = max(self.peak_rooms[room], other.peak_rooms[room])
+        self.aborts.merge(other.aborts)
+        self.message_length.merge(other.message_length)
+        self.session_length.merge(other.session_length)
+
+    def report(self, top=10):
+        def quantiles(sketch):
+            return {f"p{int(q * 100)}": sketch.quantile(q) for q in (0.5, 0.9, 0.99)}
+
+        return {
+            "files": self.files,
+            "entries": self.entries,
+            "actions": dict(self.actions.most_common()),
+            "distinct_users": self.users.count(),
+            "distinct_ips": self.ips.count(),
+            "peak_connections": self.peak_connections,
+            "peak_room_users": self.peak_rooms,
+            "messages_per_hour": dict(sorted(self.hourly.items())),
+            "message_length": quantiles(self.message_length),
+            "session_seconds": quantiles(self.session_length),
+            "most_aborted_ips": self.aborts.top(top),
+        }
+
+def analyze_file(filename):
+    return LogStats().feed_file(filename)
+
+def analyze(paths, jobs=None):
+    stats = LogStats()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for file_stats in pool.map(analyze_file, paths):
+            stats.merge(file_stats)
+    return stats
+
+def print_report(report, top=10):
+    def fmt(value):
+        return "-" if value is None else f"{value:.1f}"
+
+    print(f"files: {report['files']}  entries: {report['entries']}")
+    print("actions: " + ", ".join(f"{k} {v}" for k, v in report["actions"].items()))
+    print(f"distinct users: ~{report['distinct_users']}  distinct ips: ~{report['distinct_ips']}")
+    print(f"peak concurrent connections: {report['peak_connections']}")
+    print("peak concurrent users per room: " + ", ".join(f"{k} {v}" for k, v in report["peak_room_users"].items()))
+    print("message length: " + ", ".join(f"{k} {fmt(v)}" for k, v in report["message_length"].items()))
+    print("session seconds: " + ", ".join(f"{k} {fmt(v)}" for k, v in report["session_seconds"].items()))
+
+    print("busiest hours:")
+    hourly = sorted(report["messages_per_hour"].items(), key=lambda kv: -kv[1])[:top]
+    for hour, n in hourly:
+        print(f"  {hour}:00  {n}")
+    print("most aborted ips:")
+    for ip, n in report["most_aborted_ips"]:
+        print(f"  {ip:<16} {n}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="aggregate reports over pictochat logs")
+    parser.add_argument("paths", nargs="*", default=["."], help="log files or directories of logs")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("-n", "--top", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print the full report as json")
+    args = parser.parse_args()
+
+    report = analyze(expand_paths(args.paths), args.jobs).report(args.top)
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print_report(report, args.top)
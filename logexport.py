@@ -0,0 +1,163 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+
+from PIL import Image
+
+from logimage import IMAGE_SIZE, blank_image, decode_image
+from logparse import expand_paths, merge_logs, range_bound, remote_str
+
+SUMMARY_FIELDS = ("sheet", "cell", "timestamp", "user", "room", "remote", "data")
+
+def message_user(item, names):
+    # older clients send no user field, fall back to the name the remote
+    # last set, like logindex does
+    return item["message"].get("user") or names.get(remote_str(item.get("remote")), "")
+
+def group_key(item, group, names):
+    if group == "room":
+        return item.get("room", "")
+    return message_user(item, names)
+
+def safe_name(key):
+    return re.sub(r"[^A-Za-z0-9_-]", "_", key) or "_"
+
+def render_sheet(filename, images, columns, rows):
+    # runs in a worker process: decode every drawing and write one PNG
+    width, height = IMAGE_SIZE
+    sheet = Image.new("RGB", (columns * width, rows * height), (0xaa, 0xaa, 0xaa))
+    for i, image in enumerate(images):
+        # the server only checks the length, a garbled drawing gets a blank
+        # cell instead of failing the export
+        try:
+            cell = decode_image(image)
+        except ValueError:
+            cell = blank_image()
+        sheet.paste(cell, ((i % columns) * width, (i // columns) * height))
+    used = (len(images) + columns - 1) // columns
+    if used < rows:
+        sheet = sheet.crop((0, 0, columns * width, used * height))
+    sheet.save(filename)
+    return filename
+
+class SheetExporter:
+    def __init__(self, out_dir, group="user", columns=8, rows=8, jobs=None):
+        self.out_dir = out_dir
+        self.group = group
+        self.columns = columns
+        self.rows = rows
+        jobs = jobs or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=jobs)
+        self.max_pending = 2 * jobs
+        self.pending = set()
+        self.sheets = {}
+        self.cells = {}
+        self.summary = []
+        self.names = {}
+        self.filenames = {}
+
+    def username(self, item):
+        self.names[remote_str(item.get("remote"))] = item.get("username", "")
+
+    def file_key(self, key):
+        # different users can sanitise to the same name ("a b" and "a_b",
+        # or any two non-ascii names of the same length), give every later
+        # one a hash of the real name so their sheets don't overwrite
+        name = self.filenames.get(key)
+        if name is None:
+            name = safe_name(key)
+            taken = set(self.filenames.values())
+            if name in taken:
+                base = f"{name}-{hashlib.sha1(key.encode()).hexdigest()[:6]}"
+                name, n = base, 2
+                while name in taken:
+                    name = f"{base}-{n}"
+                    n += 1
+            self.filenames[key] = name
+        return name
+
+    def add(self, item):
+        key = self.file_key(group_key(item, self.group, self.names))
+        images = self.cells.setdefault(key, [])
+        n = self.sheets.get(key, 0)
+        filename = os.path.join(self.out_dir, f"{key}-{n:03d}.png")
+
+        message = item["message"]
+        self.summary.append({
+            "sheet": os.path.basename(filename),
+            "cell": len(images),
+            "timestamp": item.get("timestamp", ""),
+            "user": message_user(item, self.names),
+            "room": item.get("room", ""),
+            "remote": remote_str(item.get("remote")),
+            "data": message.get("data", ""),
+        })
+        images.append(message["image"])
+        if len(images) == self.columns * self.rows:
+            self.flush(key)
+
+    def flush(self, key):
+        images = self.cells.pop(key, None)
+        if not images:
+            return
+        n = self.sheets.get(key, 0)
+        self.sheets[key] = n + 1
+        filename = os.path.join(self.out_dir, f"{key}-{n:03d}.png")
+
+        # bound the amount of undecoded work held in memory
+        while len(self.pending) >= self.max_pending:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        self.pending.add(self.pool.submit(render_sheet, filename, images, self.columns, self.rows))
+
+    def finish(self):
+        for key in list(self.cells):
+            self.flush(key)
+        for future in self.pending:
+            future.result()
+        self.pending = set()
+        self.pool.shutdown()
+
+    def write_summary(self, fmt):
+        if fmt == "json":
+            with open(os.path.join(self.out_dir, "summary.json"), "w") as f:
+                f.write(json.dumps(self.summary, indent=1))
+        else:
+            with open(os.path.join(self.out_dir, "summary.csv"), "w", newline="") as f:
+                writer = csv.DictWriter(f, SUMMARY_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.summary)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render drawings from pictochat logs into PNG contact sheets")
+    parser.add_argument("paths", nargs="+", help="log files or directories of logs")
+    parser.add_argument("-o", "--out", default="export", help="output directory")
+    parser.add_argument("-g", "--group", choices=("user", "room"), default="user")
+    parser.add_argument("-c", "--columns", type=int, default=8)
+    parser.add_argument("-r", "--rows", type=int, default=8)
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("-f", "--format", choices=("csv", "json"), default="csv", help="summary format")
+    parser.add_argument("--from", dest="start", default="", help="e.g. '2021-06-01 12:00'")
+    parser.add_argument("--to", dest="end", default="")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+
+    _, items = merge_logs(expand_paths(args.paths), range_bound(args.start), range_bound(args.end, end=True))
+    exporter = SheetExporter(args.out, args.group, args.columns, args.rows, args.jobs)
+    for item in items:
+        if item.get("action") == "username":
+            exporter.username(item)
+        elif item.get("action") == "message" and item.get("message", {}).get("image"):
+            exporter.add(item)
+    exporter.finish()
+    exporter.write_summary(args.format)
+
+    print(f"exported {len(exporter.summary)} drawings to {sum(exporter.sheets.values())} sheets in '{args.out}'")
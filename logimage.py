@@ -0,0 +1,23 @@
+from base64 import b64decode
+
+from PIL import Image
+
+IMAGE_SIZE = (230, 80)
+BLANK_IMAGE = None
+
+def blank_image():
+    global BLANK_IMAGE
+    if not BLANK_IMAGE:
+        BLANK_IMAGE = Image.new("RGBA", IMAGE_SIZE, (0xff, 0xff, 0xff, 0xff))
+    return BLANK_IMAGE
+
+def decode_bitmap(imageStr):
+    # the drawing is one continuous LSB-first bit stream with set bits
+    # black, and 230 is not a multiple of 8, so rows are not byte aligned;
+    # unpack it as a single row and reshape instead of going pixel by pixel
+    data = b64decode(imageStr)
+    line = Image.frombytes("1", (len(data) * 8, 1), data, "raw", "1;IR")
+    return Image.frombytes("L", IMAGE_SIZE, line.convert("L").tobytes())
+
+def decode_image(imageStr):
+    return decode_bitmap(imageStr).convert("RGBA")
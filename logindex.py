@@ -0,0 +1,246 @@
+import os
+import re
+import sqlite3
+import sys
+
+from logparse import iter_log_numbered, log_archives, open_log, remote_str
+
+INDEX_FILE = "logs/index.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    size INTEGER,
+    mtime REAL,
+    lines INTEGER,
+    head TEXT
+);
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    archive INTEGER,
+    line INTEGER,
+    timestamp TEXT,
+    action TEXT,
+    user TEXT,
+    remote TEXT,
+    room TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS docs_archive ON docs (archive, action);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT,
+    doc INTEGER,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS drawings (
+    doc INTEGER PRIMARY KEY,
+    hash TEXT
+);
+"""
+
+WORD_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r'(\w+):("[^"]*"|\S+)|"([^"]*)"|(\S+)')
+FIELDS = ("user", "ip", "action", "room")
+
+def tokenize(text):
+    return set(WORD_RE.findall(text.lower()))
+
+def parse_query(query):
+    terms = set()
+    phrases = []
+    for field, value, phrase, word in QUERY_RE.findall(query):
+        if field and field.lower() in FIELDS:
+            terms.add(f"{field.lower()}:{value.strip(chr(34)).lower()}")
+        elif phrase:
+            terms.update(tokenize(phrase))
+            phrases.append(phrase.lower())
+        else:
+            terms.update(tokenize(word or f"{field} {value}"))
+    return terms, phrases
+
+class LogIndex:
+    def __init__(self, filename=INDEX_FILE):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.mkdir(dirname)
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        # built from the drawings table on the first similar() and kept up
+        # to date from there, up to doc tree_last
+        self.tree = None
+        self.tree_last = 0
+
+    def close(self):
+        self.db.close()
+
+    def update(self, paths):
+        changed = 0
+        for path in paths:
+            if self.update_archive(path):
+                changed += 1
+        return changed
+
+    def update_archive(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with open_log(path) as f:
+            head = f.readline()
+        row = self.db.execute("SELECT id, size, mtime, lines, head FROM archives WHERE path = ?", (path,)).fetchone()
+
+        start = 0
+        if row:
+            archive, size, mtime, start, old_head = row
+            if size == stat.st_size and mtime == stat.st_mtime:
+                return False
+            if path.endswith(".gz") or stat.st_size < size or head != old_head:
+                # rewritten rather than appended to, start over
+                self.drop_archive(archive)
+                row = None
+                start = 0
+        if not row:
+            archive = self.db.execute(
+                "INSERT INTO archives (path, size, mtime, lines) VALUES (?, ?, ?, 0)", (path, 0, 0)
+            ).lastrowid
+
+        # remote -> username, so entries without a user field can be attributed
+        names = dict(self.db.execute(
+            "SELECT remote, user FROM docs WHERE archive = ? AND action = 'username' ORDER BY line", (archive,)
+        ))
+
+        # hashing drawings needs Pillow, searching the index doesn't
+        from logsimilar import drawing_hash
+
+        lines = start
+        for lineno, item in iter_log_numbered(path, start):
+            lines = lineno + 1
+            self.add_doc(archive, lineno, item, names, drawing_hash)
+
+        self.db.execute(
+            "UPDATE archives SET size = ?, mtime = ?, lines = ?, head = ? WHERE id = ?",
+            (stat.st_size, stat.st_mtime, lines, head, archive)
+        )
+        self.db.commit()
+        return True
+
+    def drop_archive(self, archive):
+        self.tree = None
+        self.db.execute("DELETE FROM drawings WHERE doc IN (SELECT id FROM docs WHERE archive = ?)", (archive,))
+        self.db.execute("DELETE FROM postings WHERE doc IN (SELECT id FROM docs WHERE archive = ?)", (archive,))
+        self.db.execute("DELETE FROM docs WHERE archive = ?", (archive,))
+        self.db.execute("DELETE FROM archives WHERE id = ?", (archive,))
+
+    def add_doc(self, archive, lineno, item, names, drawing_hash):
+        action = item.get("action", "")
+        if not action:
+            return
+        image_hash = None
+        remote = remote_str(item.get("remote"))
+        room = item.get("room", "")
+        data = ""
+        user = names.get(remote, "")
+
+        if action == "username":
+            user = item.get("username", "")
+            names[remote] = user
+        elif action == "message":
+            message = item.get("message", {})
+            user = message.get("user") or user
+            data = message.get("data", "")
+            image_hash = drawing_hash(message.get("image"))
+
+        doc = self.db.execute(
+            "INSERT INTO docs (archive, line, timestamp, action, user, remote, room, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (archive, lineno, item.get("timestamp", ""), action, user, remote, room, data)
+        ).lastrowid
+        if image_hash is not None:
+            self.db.execute("INSERT INTO drawings (doc, hash) VALUES (?, ?)", (doc, f"{image_hash:032x}"))
+
+        terms = tokenize(data)
+        terms.add(f"action:{action}")
+        if user:
+            terms.add(f"user:{user.lower()}")
+        if remote:
+            terms.add(f"ip:{remote.rsplit(':', 1)[0]}")
+        if room:
+            terms.add(f"room:{room.lower()}")
+        self.db.executemany("INSERT OR IGNORE INTO postings (term, doc) VALUES (?, ?)", ((t, doc) for t in terms))
+
+    def search(self, query, limit=1000):
+        terms, phrases = parse_query(query)
+        if not terms:
+            return []
+
+        matches = " INTERSECT ".join("SELECT doc FROM postings WHERE term = ?" for _ in terms)
+        rows = self.db.execute(
+            "SELECT archives.path, docs.line, docs.timestamp, docs.action, docs.user, docs.remote, docs.room, docs.data"
+            " FROM docs JOIN archives ON archives.id = docs.archive"
+            f" WHERE docs.id IN ({matches}) ORDER BY docs.timestamp, docs.line",
+            tuple(terms)
+        )
+
+        results = []
+        for path, line, ts, action, user, remote, room, data in rows:
+            if phrases and not all(p in data.lower() for p in phrases):
+                continue
+            results.append(self.make_item(path, line, ts, action, user, remote, room, data))
+            if len(results) >= limit:
+                break
+        return results
+
+    def similar(self, image_hash, radius, limit=1000):
+        # drawings within radius bits of image_hash, closest first
+        from logsimilar import BKTree
+        if self.tree is None:
+            self.tree = BKTree()
+            self.tree_last = 0
+        rows = self.db.execute("SELECT doc, hash FROM drawings WHERE doc > ? ORDER BY doc", (self.tree_last,))
+        for doc, h in rows:
+            self.tree.add(int(h, 16), doc)
+            self.tree_last = doc
+
+        results = []
+        for distance, doc in self.tree.search(image_hash, radius)[:limit]:
+            row = self.db.execute(
+                "SELECT archives.path, docs.line, docs.timestamp, docs.action, docs.user, docs.remote, docs.room, docs.data"
+                " FROM docs JOIN archives ON archives.id = docs.archive WHERE docs.id = ?",
+                (doc,)
+            ).fetchone()
+            item = self.make_item(*row)
+            item["distance"] = distance
+            results.append(item)
+        return results
+
+    def make_item(self, path, line, ts, action, user, remote, room, data):
+        # a lightweight stand-in for the log entry, read_entry() on
+        # "_source" gives back the full original (including the image)
+        item = {"timestamp": ts, "action": action, "_source": [path, line]}
+        if remote:
+            ip, port = remote.rsplit(":", 1)
+            item["remote"] = [ip, int(port)]
+        if room:
+            item["room"] = room
+        if action == "username":
+            item["username"] = user
+        elif action == "message":
+            item["message"] = {"user": user, "data": data, "image": ""}
+        return item
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("build", "search"):
+        print(f"usage: {sys.argv[0]} build [log root]")
+        print(f"       {sys.argv[0]} search <query>")
+        sys.exit(1)
+
+    index = LogIndex()
+    if sys.argv[1] == "build":
+        root = sys.argv[2] if len(sys.argv) > 2 else "."
+        paths = log_archives(root)
+        print(f"indexed {index.update(paths)} of {len(paths)} log files")
+    else:
+        for item in index.search(" ".join(sys.argv[2:])):
+            user = item.get("message", {}).get("user") or item.get("username", "")
+            data = item.get("message", {}).get("data", "")
+            print(f"[{item['timestamp']}] {item['action']:<10} {user:<10} {data}")
+    index.close()
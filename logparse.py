@@ -0,0 +1,236 @@
+from collections import OrderedDict
+from itertools import islice
+import glob
+import gzip
+import heapq
+import os
+import re
+import time
+
+import fastjson
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+ARCHIVE_RE = re.compile(r"log-(\d{8}-\d{6})\.json\.gz$")
+
+
+def open_log(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt")
+    return open(filename, "r")
+
+def iter_log_numbered(filename, start=0):
+    # yields (line number, entry); a trailing line without a newline is
+    # still being written by the server, so it is left for the next read
+    with open_log(filename) as f:
+        for lineno, line in enumerate(islice(f, start, None), start):
+            if not line.endswith("\n"):
+                break
+            try:
+                yield lineno, fastjson.loads(line)
+            except ValueError:
+                pass
+
+def iter_log(filename):
+    for _, item in iter_log_numbered(filename):
+        yield item
+
+def read_log(filename):
+    return list(iter_log(filename))
+
+def read_entry(filename, lineno):
+    for _, item in iter_log_numbered(filename, lineno):
+        return item
+    return None
+
+def parse_item(item):
+    action = item["action"]
+    if action == "connect":
+        return ("SERVER/connect", str(item))
+    elif action == "status":
+        return ("SERVER/status", str(item))
+    elif action == "username":
+        return ("SERVER/username", str(item))
+    elif action == "join":
+        return ("SERVER/join", str(item))
+    elif action == "disconnect":
+        return ("SERVER/disconnect", str(item))
+    elif action == "message":
+        try:
+            user = item["message"]["user"]
+        except:
+            user = "<NO USER>"
+        return (
+            user,
+            "<{}>: {}".format(user, item["message"]["data"]),
+            item["message"]["image"] if len(item["message"]["image"]) > 0 else None
+        )
+
+def remote_str(remote):
+    if not remote:
+        return ""
+    return f"{remote[0]}:{remote[1]}"
+
+def log_archives(root="."):
+    paths = glob.glob(os.path.join(root, "log-*.json.gz"))
+    paths += glob.glob(os.path.join(root, "logs", "log-*.json.gz"))
+    live = os.path.join(root, "log.json")
+    if os.path.exists(live):
+        paths.append(live)
+    return [path for _, _, path in log_ranges(paths)]
+
+def expand_paths(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += log_archives(path)
+        else:
+            files.append(path)
+    return files
+
+def log_end_time(filename):
+    # archives are named after the mtime of the log.json they were made
+    # from, so both give the time of the last entry without reading the file
+    match = ARCHIVE_RE.search(filename)
+    if match:
+        end = time.strptime(match.group(1), "%Y%m%d-%H%M%S")
+    else:
+        end = time.localtime(os.path.getmtime(filename))
+    return time.strftime(TIME_FORMAT, end)
+
+def log_ranges(paths):
+    # each log starts where the previous server run's log ended
+    ends = sorted((log_end_time(path), path) for path in paths)
+    ranges = []
+    start = None
+    for end, path in ends:
+        ranges.append((start, end, path))
+        start = end
+    return ranges
+
+def range_bound(string, end=False):
+    # "2021-06-01" as a start means 00:00:00, as an end 23:59:59
+    if not string:
+        return None
+    pad = "9999-12-31 23:59:59" if end else "0000-01-01 00:00:00"
+    return string + pad[len(string):]
+
+def timestamp_key(item):
+    return item.get("timestamp", "")
+
+def iter_log_range(filename, start=None, end=None):
+    for item in iter_log(filename):
+        ts = timestamp_key(item)
+        if start and ts < start:
+            continue
+        if end and ts > end:
+            break
+        yield item
+
+def logs_in_range(paths, start=None, end=None):
+    # in time order, skipping files that end before start or begin after end
+    files = []
+    for file_start, file_end, path in log_ranges(paths):
+        if start and file_end < start:
+            continue
+        if end and file_start and file_start > end:
+            continue
+        files.append(path)
+    return files
+
+def merge_logs(paths, start=None, end=None):
+    files = logs_in_range(paths, start, end)
+    return files, heapq.merge(*(iter_log_range(path, start, end) for path in files), key=timestamp_key)
+
+class LogSession:
+    # entries are merged by timestamp as they are read; the files read to
+    # the end most recently are kept, so paging through the same session
+    # again mostly doesn't decompress anything, but a directory of months
+    # of logs isn't held in memory all at once
+    def __init__(self, paths, start=None, end=None, cache_files=4):
+        self.start = start
+        self.end = end
+        self.files = logs_in_range(paths, start, end)
+        self.cache_files = cache_files
+        self.cache = OrderedDict()
+
+    def file_items(self, path):
+        items = self.cache.get(path)
+        if items is not None:
+            self.cache.move_to_end(path)
+            yield from items
+            return
+        items = []
+        for item in iter_log_range(path, self.start, self.end):
+            items.append(item)
+            yield item
+        # a file left part way through is read again next time
+        self.cache[path] = items
+        if len(self.cache) > self.cache_files:
+            self.cache.popitem(last=False)
+
+    def __iter__(self):
+        return heapq.merge(*(self.file_items(path) for path in self.files), key=timestamp_key)
+
+class LogTail:
+    READ_SIZE = 1 << 20
+
+    def __init__(self, filename="log.json"):
+        self.filename = filename
+        self.file = None
+        self.inode = None
+        self.head = b""
+        self.buffer = b""
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def reopen(self):
+        self.close()
+        self.buffer = b""
+        self.head = b""
+        try:
+            self.file = open(self.filename, "rb")
+        except FileNotFoundError:
+            return
+        self.inode = os.fstat(self.file.fileno()).st_ino
+
+    def rotated(self):
+        # the server truncates log.json in place on restart ("w+"), so a
+        # shrinking file or a different first line means a new log as well
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        if self.file is None or stat.st_ino != self.inode or stat.st_size < self.file.tell():
+            return True
+        if self.head:
+            pos = self.file.tell()
+            self.file.seek(0)
+            head = self.file.read(len(self.head))
+            self.file.seek(pos)
+            return head != self.head
+        return False
+
+    def poll(self):
+        # returns (rotated, new entries); only bytes past the last read are touched
+        rotated = self.rotated()
+        if rotated:
+            self.reopen()
+        if self.file is None:
+            return rotated, []
+
+        data = self.buffer + self.file.read(self.READ_SIZE)
+        lines = data.split(b"\n")
+        self.buffer = lines.pop()
+        if not self.head and lines:
+            self.head = lines[0][:64]
+
+        items = []
+        for line in lines:
+            try:
+                items.append(fastjson.loads(line))
+            except ValueError:
+                pass
+        return rotated, items
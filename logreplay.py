@@ -0,0 +1,328 @@
+from datetime import datetime
+import argparse
+import asyncio
+import ipaddress
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import websockets
+
+import fastjson
+from logparse import TIME_FORMAT, expand_paths, merge_logs, range_bound, remote_str
+
+CLIENT_ACTIONS = ("status", "username", "join", "leave", "message", "batch")
+REPLY_TIMEOUT = 2.0 # seconds to wait for outstanding replies before closing
+FIRST_LOOPBACK = int(ipaddress.ip_address("127.1.0.1"))
+
+class Session():
+    def __init__(self, remote, start):
+        self.remote = remote
+        self.start = start
+        self.end = None
+        self.actions = [] # (time, client message)
+
+def parse_time(ts):
+    return datetime.strptime(ts, TIME_FORMAT).timestamp()
+
+def load_sessions(paths, start=None, end=None):
+    # every inbound action was logged with its remote address, so the
+    # client side of each connection can be rebuilt from connect to
+    # disconnect; a connect on an address that is still open means the
+    # server was restarted in between
+    _, items = merge_logs(paths, start, end)
+    sessions = []
+    live = {}
+    for item in items:
+        action = item.get("action")
+        remote = item.get("remote")
+        if not action or not remote:
+            continue
+        key = remote_str(remote)
+        t = parse_time(item["timestamp"])
+        if action == "connect":
+            live[key] = Session(remote, t)
+            sessions.append(live[key])
+        elif action in ("disconnect", "abort"):
+            session = live.pop(key, None)
+            if session:
+                session.end = t
+        elif action in CLIENT_ACTIONS:
+            if key not in live:
+                # the range starts in the middle of this connection
+                live[key] = Session(remote, t)
+                sessions.append(live[key])
+            message = {k: v for k, v in item.items() if k not in ("remote", "timestamp")}
+            live[key].actions.append((t, message))
+
+    for session in sessions:
+        spread_actions(session)
+    return sessions
+
+def spread_actions(session):
+    # timestamps only have whole seconds, so actions logged in the same
+    # second are spaced out evenly across it instead of sent as a burst
+    actions = session.actions
+    i = 0
+    while i < len(actions):
+        j = i
+        while j < len(actions) and actions[j][0] == actions[i][0]:
+            j += 1
+        for k in range(i, j):
+            actions[k] = (actions[k][0] + (k - i) / (j - i), actions[k][1])
+        i = j
+    if actions and session.end is not None:
+        session.end = max(session.end, actions[-1][0])
+
+class ReplayClock():
+    # speed 1 is real time, 10 is ten times faster, 0 is as fast as possible
+    def __init__(self, origin, speed):
+        self.origin = origin
+        self.speed = speed
+        self.started = time.monotonic()
+        self.behind = 0.0
+
+    async def wait(self, t):
+        if not self.speed:
+            await asyncio.sleep(0)
+            return
+        delay = self.started + (t - self.origin) / self.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            self.behind = max(self.behind, -delay)
+
+class ReplayStats():
+    def __init__(self):
+        self.sessions = 0
+        self.failed = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.frames = 0
+        self.received_bytes = 0
+        self.unanswered = 0
+        self.latency = {} # action -> [seconds]
+
+    def percentile(self, values, q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def report(self, duration, behind):
+        latency = {}
+        for action, values in sorted(self.latency.items()):
+            values = sorted(values)
+            latency[action] = {
+                "n": len(values),
+                "p50": self.percentile(values, 0.5) * 1000,
+                "p90": self.percentile(values, 0.9) * 1000,
+                "p99": self.percentile(values, 0.99) * 1000,
+                "max": values[-1] * 1000,
+            }
+        return {
+            "sessions": self.sessions,
+            "failed_connects": self.failed,
+            "duration": duration,
+            "sent": self.sent,
+            "received": self.received,
+            "received_frames": self.frames,
+            "sent_per_second": self.sent / duration if duration else 0,
+            "received_per_second": self.received / duration if duration else 0,
+            "received_bytes_per_second": self.received_bytes / duration if duration else 0,
+            "unanswered": self.unanswered,
+            "max_schedule_lag": behind,
+            "latency_ms": latency,
+        }
+
+def expected_reply(message, rooms):
+    # what the server sends back for a client message, as a predicate on
+    # the reply, or None when nothing comes back to the sender
+    action = message["action"]
+    if action in ("status", "username", "join", "batch"):
+        return lambda reply: reply.get("type") == action
+    if action == "message":
+        sent = message.get("message", {})
+        if message.get("room") not in rooms or str(sent.get("data", "")).startswith("%admin"):
+            return None
+        sent = {k: v for k, v in sent.items() if k != "user"}
+        return lambda reply: (
+            reply.get("type") == "message"
+            and {k: v for k, v in reply.get("message", {}).items() if k != "user"} == sent
+        )
+    return None
+
+async def read_replies(websocket, pending, drained, stats):
+    try:
+        async for data in websocket:
+            now = time.monotonic()
+            stats.frames += 1
+            stats.received_bytes += len(data)
+            try:
+                replies = fastjson.loads(data)
+            except ValueError:
+                continue
+            if not isinstance(replies, list):
+                replies = [replies]
+            stats.received += len(replies)
+            for reply in replies:
+                for i, (action, matches, sent_at) in enumerate(pending):
+                    if matches(reply):
+                        stats.latency.setdefault(action, []).append(now - sent_at)
+                        del pending[i]
+                        break
+            if not pending:
+                drained.set()
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    drained.set()
+
+async def replay_session(session, url, clock, stats, local_addr=None, batch=0):
+    await clock.wait(session.start)
+    try:
+        if local_addr:
+            websocket = await websockets.connect(url, local_addr=local_addr)
+        else:
+            websocket = await websockets.connect(url)
+    except (OSError, websockets.exceptions.WebSocketException):
+        stats.failed += 1
+        return
+    stats.sessions += 1
+
+    pending = [] # (action, reply predicate, send time)
+    rooms = set()
+    drained = asyncio.Event()
+    reader = asyncio.ensure_future(read_replies(websocket, pending, drained, stats))
+    actions = session.actions
+    if batch:
+        actions = [(session.start, {"action": "batch", "window": batch})] + actions
+    try:
+        for t, message in actions:
+            await clock.wait(t)
+            if message["action"] == "join":
+                rooms.add(message.get("room"))
+            elif message["action"] == "leave":
+                rooms.discard(message.get("room"))
+            data = fastjson.dumps(message)
+            matches = expected_reply(message, rooms)
+            if matches:
+                drained.clear()
+                pending.append((message["action"], matches, time.monotonic()))
+            await websocket.send(data)
+            stats.sent += 1
+            stats.sent_bytes += len(data)
+        if session.end is not None:
+            await clock.wait(session.end)
+        if pending:
+            try:
+                await asyncio.wait_for(drained.wait(), REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        await websocket.close()
+        await reader
+    stats.unanswered += len(pending)
+
+async def replay(sessions, url, speed, spread_ips=False, batch=0):
+    stats = ReplayStats()
+    if not sessions:
+        return stats.report(0, 0)
+    clock = ReplayClock(min(session.start for session in sessions), speed)
+
+    # against a local server each original ip gets its own loopback
+    # address, so bans and per-ip state land on the right replayed clients
+    loopback = {}
+    jobs = []
+    for session in sessions:
+        local_addr = None
+        if spread_ips:
+            ip = session.remote[0]
+            if ip not in loopback:
+                loopback[ip] = str(ipaddress.ip_address(FIRST_LOOPBACK + len(loopback)))
+            local_addr = (loopback[ip], 0)
+        jobs.append(replay_session(session, url, clock, stats, local_addr, batch))
+    await asyncio.gather(*jobs)
+    return stats.report(time.monotonic() - clock.started, clock.behind)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def serve_local(port, workdir, ready):
+    # server.py rotates log.json and writes its ban list, motd and admin
+    # secret into the working directory on import, so it runs in a
+    # scratch directory of its own
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, "w")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    import server
+    loop.create_task(server.LOGGER.log_loop())
+    loop.create_task(server.reap_idle())
+    loop.run_until_complete(server.serve("127.0.0.1", port))
+    ready.set()
+    loop.run_forever()
+
+def print_report(report):
+    def rate(n):
+        return f"{n:.1f}/s"
+
+    print(f"sessions: {report['sessions']}  failed connects: {report['failed_connects']}")
+    print(f"duration: {report['duration']:.2f}s  max schedule lag: {report['max_schedule_lag'] * 1000:.1f}ms")
+    print(f"sent: {report['sent']} ({rate(report['sent_per_second'])})  "
+          f"received: {report['received']} in {report['received_frames']} frames "
+          f"({rate(report['received_per_second'])}, {report['received_bytes_per_second'] / 1024:.1f} KiB/s)")
+    print(f"unanswered: {report['unanswered']}")
+    print(f"{'latency ms':<12} {'n':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for action, row in report["latency_ms"].items():
+        print(f"{action:<12} {row['n']:>7} {row['p50']:>8.2f} {row['p90']:>8.2f} {row['p99']:>8.2f} {row['max']:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay recorded pictochat sessions against a server")
+    parser.add_argument("paths", nargs="*", default=["."], help="log files or directories of logs")
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="time scale, 1 is real time (default)")
+    parser.add_argument("--max-speed", action="store_true", help="send everything as fast as possible")
+    parser.add_argument("-u", "--url", default=None, help="server to replay against (default: start server.app locally)")
+    parser.add_argument("--from", dest="start", default="", help="e.g. '2021-06-01 12:00'")
+    parser.add_argument("--to", dest="end", default="")
+    parser.add_argument("-b", "--batch", type=int, default=0, help="ask the server to batch replies over this many ms")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+
+    sessions = load_sessions(expand_paths(args.paths), range_bound(args.start), range_bound(args.end, True))
+    print(f"{len(sessions)} sessions, {sum(len(s.actions) for s in sessions)} actions", file=sys.stderr)
+    speed = 0 if args.max_speed else args.speed
+
+    server_process = None
+    workdir = None
+    url = args.url
+    if not url:
+        workdir = tempfile.TemporaryDirectory()
+        port = free_port()
+        ready = multiprocessing.Event()
+        server_process = multiprocessing.Process(target=serve_local, args=(port, workdir.name, ready), daemon=True)
+        server_process.start()
+        if not ready.wait(10):
+            print("local server did not start", file=sys.stderr)
+            sys.exit(1)
+        url = f"ws://127.0.0.1:{port}"
+
+    try:
+        report = asyncio.run(replay(sessions, url, speed, server_process is not None, args.batch))
+    finally:
+        if server_process:
+            server_process.terminate()
+            server_process.join()
+            workdir.cleanup()
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print_report(report)
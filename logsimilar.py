@@ -0,0 +1,102 @@
+import argparse
+import sys
+
+from PIL import Image
+
+from logimage import decode_bitmap
+
+# 17x8 leaves 16 horizontal differences per row, 128 bits in all, and
+# keeps roughly the 230x80 drawing's aspect ratio
+HASH_GRID = (17, 8)
+DEFAULT_RADIUS = 20
+
+def drawing_hash(imageStr):
+    # difference hash: shrink the drawing to a few grey blocks and record
+    # whether each block is darker than its right neighbour. small edits,
+    # shifts by a pixel or two and redrawn strokes change few bits.
+    # returns None for empty or undecodable drawings
+    if not imageStr:
+        return None
+    try:
+        small = decode_bitmap(imageStr).resize(HASH_GRID, Image.BOX)
+    except ValueError:
+        return None
+    pixels = small.tobytes()
+    width, height = HASH_GRID
+    h = 0
+    for y in range(height):
+        row = pixels[y * width:(y + 1) * width]
+        for x in range(width - 1):
+            h = (h << 1) | (row[x] < row[x + 1])
+    # a blank page has no edges, and would match every other blank page
+    return h or None
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class BKTree():
+    # nodes are [hash, values, {distance: child}]. every child is at a
+    # known distance from its parent, so by the triangle inequality a
+    # search only descends into children within radius of that distance
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, h, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, [value], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [value], {}]
+                return
+            node = child
+
+    def search(self, h, radius):
+        # [(distance, value)], closest first
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                results.extend((d, value) for value in node[1])
+            for child_d, child in node[2].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        results.sort()
+        return results
+
+
+if __name__ == "__main__":
+    from logindex import LogIndex
+    from logparse import log_archives, read_entry
+
+    parser = argparse.ArgumentParser(description="find drawings similar to one in a log")
+    parser.add_argument("log", help="log file the drawing is in")
+    parser.add_argument("line", type=int, help="line number of the message, starting at 0")
+    parser.add_argument("-r", "--radius", type=int, default=DEFAULT_RADIUS, help=f"max differing hash bits, out of 128 (default {DEFAULT_RADIUS})")
+    parser.add_argument("--root", default=".", help="log root to index first (default: .)")
+    args = parser.parse_args()
+
+    item = read_entry(args.log, args.line)
+    h = drawing_hash((item or {}).get("message", {}).get("image"))
+    if h is None:
+        sys.exit("no drawing on that line")
+
+    index = LogIndex()
+    index.update(log_archives(args.root))
+    for result in index.similar(h, args.radius):
+        path, line = result["_source"]
+        print(f"{result['distance']:>3} [{result['timestamp']}] {result['message']['user']:<10} {path}:{line}")
+    index.close()
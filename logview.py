@@ -1,51 +1,31 @@
-from base64 import b64decode
-import gzip
-import json
-
+from itertools import islice
 import tkinter as tk
-from tkinter.filedialog import askopenfilename
+from tkinter.filedialog import askopenfilename, askdirectory
 import pygubu
-from PIL import Image, ImageTk
-
-
-def bits(number):
-    yield 0 if number & 0b00000001 != 0 else 1
-    yield 0 if number & 0b00000010 != 0 else 1
-    yield 0 if number & 0b00000100 != 0 else 1
-    yield 0 if number & 0b00001000 != 0 else 1
-    yield 0 if number & 0b00010000 != 0 else 1
-    yield 0 if number & 0b00100000 != 0 else 1
-    yield 0 if number & 0b01000000 != 0 else 1
-    yield 0 if number & 0b10000000 != 0 else 1
-
-BLANK_IMAGE = Image.new("RGBA", (230, 80), (0xff, 0xff, 0xff, 0xff))
-
-def decode_image(imageStr):
-    bytes = b64decode(imageStr)
-    width = 230
-    height = 80
-    im = Image.new("RGBA", (width, height), (0xff, 0xff, 0xff, 0xff))
-
-    x = 0
-    y = 0
-    for byte in bytes:
-        for bit in bits(byte):
-            im.putpixel((x, y), (0xff, 0xff, 0xff, 0xff) if bit else (0x00, 0x00, 0x00, 0xff))
-            x += 1
-            if x >= width:
-                y += 1
-                x = 0
-    return im
+# PIL (through logimage) and the search index are imported on first use,
+# so the window shows up without waiting for them
+
+from logparse import LogSession, LogTail, log_archives, parse_item, range_bound, read_log, read_entry
+
 
 class LogViewApp(pygubu.TkApplication):
+    TAIL_INTERVAL = 250
+    PAGE_SIZE = 500
+
     def __init__(self):
         self.builder = pygubu.Builder()
         self.builder.add_from_file("logview.ui")
         self.mainwindow = self.builder.get_object("mainwindow")
         self.builder.connect_callbacks(self)
         self.builder.get_object("message_list").bind("<<TreeviewSelect>>", self.tree_select)
+        self.builder.get_object("message_list").config(yscrollcommand=self.tree_scrolled)
         self.json_data = []
         self.tree_data = []
+        self.pending = None
+        self.page_job = None
+        self.index = None
+        self.tail = None
+        self.tail_job = None
 
     def run(self):
         self.mainwindow.mainloop()
@@ -54,8 +34,95 @@ class LogViewApp(pygubu.TkApplication):
         self.filename = askopenfilename(filetypes=(("log files", "*.json"),("log files", "*.json.gz"),("all files","*.*")))
         self.builder.get_object("filename").config(text=self.filename)
         if len(self.filename) > 0:
+            self.stop_tail()
             self.load_log(self.filename)
 
+    def on_directory_button(self):
+        directory = askdirectory(mustexist=True)
+        if directory:
+            self.stop_tail()
+            self.load_session(directory)
+
+    def on_tail_toggle(self):
+        if self.builder.get_variable("tail_var").get():
+            self.start_tail()
+        else:
+            self.stop_tail()
+
+    def start_tail(self, filename="log.json"):
+        self.stop_tail()
+        self.tail = LogTail(filename)
+        self.filename = filename
+        self.builder.get_object("filename").config(text=f"{filename} (following)")
+        self.json_data = []
+        self.update_tree()
+        self.tail_poll()
+
+    def stop_tail(self):
+        if self.tail_job:
+            self.mainwindow.after_cancel(self.tail_job)
+            self.tail_job = None
+        if self.tail:
+            self.tail.close()
+            self.tail = None
+            self.builder.get_variable("tail_var").set(False)
+
+    def tail_poll(self):
+        if not self.tail:
+            return
+        rotated, items = self.tail.poll()
+        if rotated and self.json_data:
+            self.json_data = []
+            self.update_tree()
+        if items:
+            self.json_data.extend(items)
+            self.append_tree(items)
+        # new lines are picked up in batches, at most TAIL_INTERVAL apart
+        self.tail_job = self.mainwindow.after(self.TAIL_INTERVAL, self.tail_poll)
+
+    def on_search_button(self, event=None):
+        query = self.builder.get_variable("search_var").get().strip()
+        if not query:
+            return
+        self.stop_tail()
+        self.open_index()
+        self.filename = ""
+        self.builder.get_object("filename").config(text=f"Search: {query}")
+        self.json_data = self.index.search(query)
+        self.update_tree()
+
+    def open_index(self):
+        if not self.index:
+            from logindex import LogIndex
+            self.index = LogIndex()
+        self.index.update(log_archives())
+
+    def selected_message(self):
+        message_list = self.builder.get_object("message_list")
+        if len(message_list.selection()) == 0:
+            return None
+        message = self.tree_data[int(message_list.selection()[0]) - 1]
+        if "_source" in message:
+            # search results only carry the indexed fields
+            message = read_entry(*message["_source"]) or message
+        return message
+
+    def on_similar_button(self):
+        from logsimilar import DEFAULT_RADIUS, drawing_hash
+        message = self.selected_message()
+        if not message:
+            return
+        image_hash = drawing_hash(message.get("message", {}).get("image"))
+        if image_hash is None:
+            return
+        self.stop_tail()
+        self.open_index()
+        user = message["message"].get("user", "")
+        self.filename = ""
+        self.json_data = self.index.similar(image_hash, DEFAULT_RADIUS)
+        self.builder.get_object("filename").config(text=f"Similar to {user}'s drawing ({len(self.json_data)} found)")
+        self.update_tree()
+
     def set_message_text(self, string):
         text = self.builder.get_object("message_text")
         text.config(state=tk.NORMAL)
@@ -64,13 +131,13 @@ class LogViewApp(pygubu.TkApplication):
         text.config(state=tk.DISABLED)
 
     def set_message_image(self, image):
+        from PIL import ImageTk
         label = self.builder.get_object("message_image")
         render = ImageTk.PhotoImage(image)
         label.config(image=render)
         label.image = render
 
     def update_tree(self):
-        json_data = self.json_data
         message_list = self.builder.get_object("message_list")
 
         if len(message_list.selection()) > 0:
@@ -80,6 +147,28 @@ class LogViewApp(pygubu.TkApplication):
         message_list["columns"] = ("user")
         message_list.heading("user", text="User")
 
+        # rows are added a page at a time as the list is scrolled, so a
+        # long session is only read as far as anyone looks
+        if self.page_job:
+            self.mainwindow.after_cancel(self.page_job)
+        self.tree_data = []
+        self.pending = iter(self.json_data)
+        self.load_page()
+
+    def load_page(self):
+        self.page_job = None
+        shown = len(self.tree_data)
+        while self.pending and len(self.tree_data) - shown < self.PAGE_SIZE:
+            items = list(islice(self.pending, self.PAGE_SIZE))
+            if len(items) < self.PAGE_SIZE:
+                self.pending = None
+            self.append_tree(items)
+
+    def tree_scrolled(self, first, last):
+        if self.pending and not self.page_job and float(last) > 0.9:
+            self.page_job = self.mainwindow.after_idle(self.load_page)
+
+    def selected_actions(self):
         actions = []
         if self.builder.get_variable("typevar_connect").get():
             actions.append("connect")
@@ -93,74 +182,52 @@ class LogViewApp(pygubu.TkApplication):
             actions.append("disconnect")
         if self.builder.get_variable("typevar_message").get():
             actions.append("message")
+        return actions
 
-        self.tree_data = []
-        index = 0
-        for item in json_data:
+    def append_tree(self, items):
+        message_list = self.builder.get_object("message_list")
+        actions = self.selected_actions()
+
+        index = len(self.tree_data)
+        for item in items:
             if "action" in item.keys():
                 if item["action"] in actions:
                     self.tree_data.append(item)
                     index += 1
-                    message_list.insert("", "end", id=index, values=( self.parse_item(item)[0] ))
-
-    def parse_item(self, item):
-        action = item["action"]
-        if action == "connect":
-            return ("SERVER/connect", str(item))
-        elif action == "status":
-            return ("SERVER/status", str(item))
-        elif action == "username":
-            return ("SERVER/username", str(item))
-        elif action == "join":
-            return ("SERVER/join", str(item))
-        elif action == "disconnect":
-            return ("SERVER/disconnect", str(item))
-        elif action == "message":
-            try:
-                user = item["message"]["user"]
-            except:
-                user = "<NO USER>"
-            return (
-                user,
-                "<{}>: {}".format(user, item["message"]["data"]),
-                item["message"]["image"] if len(item["message"]["image"]) > 0 else None
-            )
+                    message_list.insert("", "end", id=index, values=( parse_item(item)[0] ))
 
-    def tree_select(self, event):
-        message_list = self.builder.get_object("message_list")
+        if self.tail and index > 0:
+            message_list.see(index)
 
-        if len(message_list.selection()) == 0:
+    def tree_select(self, event):
+        message = self.selected_message()
+        if not message:
             return
 
-        id = message_list.selection()[0]
-        item = message_list.item(id)
-        index = int(id) - 1
-        message = self.tree_data[index]
-
-        item = self.parse_item(message)
+        from logimage import blank_image, decode_image
+        item = parse_item(message)
 
         self.set_message_text(item[1])
-        if len(item) < 3 or not item[2]:
-            self.set_message_image(BLANK_IMAGE)
-        else:
-            self.set_message_image(decode_image(item[2]))
+        image = blank_image()
+        if len(item) >= 3 and item[2]:
+            try:
+                image = decode_image(item[2])
+            except ValueError:
+                pass
+        self.set_message_image(image)
 
     def load_log(self, filename):
-        json_data = []
-        if filename.endswith(".json.gz"):
-            with gzip.open(filename, "rb") as f:
-                file_str = f.read().decode()
-                split = file_str.split("\n")
-                for line in split:
-                    try:
-                        json_data.append(json.loads(line))
-                    except:
-                        pass
-        else:
-            with open(filename, "r") as f:
-                for line in f.readlines():
-                    json_data.append(json.loads(line))
-        self.json_data = json_data
+        self.json_data = read_log(filename)
+        self.update_tree()
+
+    def load_session(self, directory):
+        start = range_bound(self.builder.get_variable("range_from_var").get().strip())
+        end = range_bound(self.builder.get_variable("range_to_var").get().strip(), end=True)
+        session = LogSession(log_archives(directory), start, end)
+
+        self.filename = directory
+        self.builder.get_object("filename").config(text=f"{directory} ({len(session.files)} files)")
+        self.json_data = session
         self.update_tree()
 
 if __name__ == "__main__" :
@@ -1,19 +1,38 @@
-import json
 from datetime import datetime, timezone
 import sys
 import os
 import gzip
+import random
+import signal
+import socket
+import subprocess
 import time
+import traceback
 
 import websockets
 import asyncio
 import pyotp
 
+import chatfilter
+import fastjson
+import wsdeflate
+
 def timestamp():
     return datetime.now(timezone.utc).timestamp()
 
 class Logger:
-    def __init__(self):
+    def __init__(self, defer=False):
+        # a server taking over from another one opens (and rotates) log.json
+        # only once the old one has paused its logging, see hand_off();
+        # until then entries wait in the queue
+        self.LOG_FILE = None
+        self.LOG_QUEUE = asyncio.Queue()
+        self.deferred = defer
+        if not defer:
+            self.open()
+
+    def open(self):
+        self.deferred = False
         if os.path.exists("log.json"):
             print("compressing old log...")
             mtime = os.path.getmtime("log.json")
@@ -27,42 +46,84 @@ class Logger:
 
             print(f"log saved as 'logs/log-{timestr}.json.gz'")
 
-        self.LOG_FILE = open("log.json", "w+")
-        self.LOG_QUEUE = asyncio.Queue()
+        # append mode, so that during a restart handoff the old and the new
+        # server can both write to log.json without overwriting each other
+        open("log.json", "w").close()
+        self.LOG_FILE = open("log.json", "a")
 
     def close(self):
         self.LOG_FILE.close()
 
+    def pause(self):
+        # while another process rotates log.json, entries wait in the queue
+        self.LOG_FILE.close()
+        self.LOG_FILE = None
+
+    def resume(self):
+        # the new process is writing log.json too, so whole lines only
+        self.LOG_FILE = open("log.json", "a", buffering=1)
+
     def _log(self, msg):
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+        print(f"[{fastjson.timestamp()}] {msg}")
         sys.stdout.flush()
 
     async def log(self, message):
+        # entries are serialized here, not when they are written, so later
+        # changes to the dict (e.g. the chat filter masking a message) do
+        # not end up in the log. queued as (line, text to print)
         if isinstance(message, dict):
-            message["timestamp"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            await self.LOG_QUEUE.put(message)
+            message["timestamp"] = fastjson.timestamp()
+            line = fastjson.dumps(message)
+            await self.LOG_QUEUE.put((line, line))
         else:
             message_dict = {
-                "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "timestamp": fastjson.timestamp(),
                 "log_message": message
             }
-            await self.LOG_QUEUE.put(message_dict)
+            await self.LOG_QUEUE.put((fastjson.dumps(message_dict), message))
 
     async def log_loop(self):
         while True:
-            while not self.LOG_QUEUE.empty():
-                message = await self.LOG_QUEUE.get()
-                if "log_message" in message.keys():
-                    self._log(message["log_message"])
-                else:
-                    self._log(json.dumps(message))
-                self.LOG_FILE.write(json.dumps(message))
-                self.LOG_FILE.write("\n")
+            while self.LOG_FILE and not self.LOG_QUEUE.empty():
+                line, printed = await self.LOG_QUEUE.get()
+                self._log(printed)
+                self.LOG_FILE.write(line + "\n")
                 await asyncio.sleep(0.1)
-            self.LOG_FILE.flush()
+            if self.LOG_FILE:
+                self.LOG_FILE.flush()
             await asyncio.sleep(0.5)
 
 
+# limits are sized for the protocol: the largest message that passes
+# preflight is a 3068 char image plus 532 chars of (escaped) text
+DEFAULT_CONFIG = {
+    "max_size": 8192, # bytes per incoming message
+    "max_queue": 4, # incoming messages buffered per connection
+    "read_limit": 16384, # bytes, high-water marks for the socket buffers
+    "write_limit": 32768,
+    "ping_interval": 20, # seconds, dead connections are dropped after
+    "ping_timeout": 20, # a ping goes unanswered this long
+    "close_timeout": 5,
+    "idle_timeout": 900, # seconds without a message from the client, 0 = never
+    "drain_time": 60, # seconds over which a restarting server closes its clients
+    "deflate": True, # permessage-deflate, tuned by the keys below
+    "deflate_min_size": 512, # bytes, smaller messages are sent uncompressed
+    "deflate_images_only": True, # only compress messages carrying a drawing
+    "deflate_window_bits": 12, # 4K window, a drawing message fits
+    "deflate_mem_level": 5,
+    "deflate_level": 6,
+    "deflate_context_takeover": False, # true keeps zlib state per connection
+}
+
+def load_config():
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists("server.conf"):
+        with open("server.conf", "r") as f:
+            config.update(fastjson.loads(f.read()))
+    return config
+
+CONFIG = load_config()
+
 if not os.path.exists("admin.secret"):
     with open("admin.secret", "w") as f:
         f.write(pyotp.random_base32())
@@ -78,14 +139,14 @@ async def check_ban(ip):
             f.write("{}")
 
     with open("banlist.txt", "r") as f:
-        bans = json.loads(f.read())
+        bans = fastjson.loads(f.read())
 
     if ip in bans:
         expire = bans[ip]
         if timestamp() > expire:
             del bans[ip]
             with open("banlist.txt", "w") as f:
-                f.write(json.dumps(bans))
+                f.write(fastjson.dumps(bans))
             return False
         return True
     return False
@@ -96,12 +157,12 @@ async def set_ban(ip):
             f.write("{}")
 
     with open("banlist.txt", "r") as f:
-        bans = json.loads(f.read())
+        bans = fastjson.loads(f.read())
 
     bans[ip] = timestamp() + (24 * 60 * 60) # 1 day
 
     with open("banlist.txt", "w") as f:
-        f.write(json.dumps(bans))
+        f.write(fastjson.dumps(bans))
 
 MOTD = ""
 async def get_motd():
@@ -119,8 +180,10 @@ async def set_motd(new_motd):
     with open("motd.txt", "w") as f:
         f.write(MOTD)
 
-LOGGER = Logger()
+LOGGER = Logger(defer="LISTEN_FD" in os.environ)
+CHAT_FILTER = chatfilter.ChatFilter("filter.txt")
 USERS = set()
+LAST_SEEN = {}
 USERNAMES = {}
 AUTH_USERS = {}
 
@@ -128,14 +191,68 @@ ROOM_A = set()
 ROOM_B = set()
 ROOM_C = set()
 ROOM_D = set()
+ROOMS = {"A": ROOM_A, "B": ROOM_B, "C": ROOM_C, "D": ROOM_D}
+
+# clients can ask for their outbound messages to be collected for a few
+# ms and sent as one frame holding a json array, instead of one frame each
+BATCH_WINDOW_MIN = 5 # ms
+BATCH_WINDOW_MAX = 50
+BATCHES = {}
+
+class Batch:
+    def __init__(self, window):
+        self.window = window
+        self.messages = []
+        self.task = None # pending flush_batch_later
+
+async def send(websocket, message_json):
+    batch = BATCHES.get(websocket)
+    if batch is None:
+        await websocket.send(message_json)
+        return
+    batch.messages.append(message_json)
+    if len(batch.messages) == 1:
+        batch.task = asyncio.ensure_future(flush_batch_later(websocket, batch))
+
+async def flush_batch_later(websocket, batch):
+    await asyncio.sleep(batch.window / 1000)
+    batch.task = None
+    await flush_batch(websocket, batch)
+
+async def flush_batch(websocket, batch):
+    if batch.task:
+        batch.task.cancel()
+        batch.task = None
+    messages = batch.messages
+    batch.messages = []
+    if not messages:
+        return
+    try:
+        await websocket.send("[" + ",".join(messages) + "]")
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+async def set_batching(websocket, window):
+    batch = BATCHES.pop(websocket, None)
+    if batch:
+        await flush_batch(websocket, batch)
+    if window:
+        window = min(max(window, BATCH_WINDOW_MIN), BATCH_WINDOW_MAX)
+    # the reply itself is still a single message
+    await websocket.send(fastjson.dumps({
+        "type": "batch",
+        "window": window
+    }))
+    if window:
+        BATCHES[websocket] = Batch(window)
 
 async def send_menu(websocket):
-    await websocket.send(json.dumps({
+    await send(websocket, fastjson.dumps({
         "type":"status",
-        "roomA":len(ROOM_A),
-        "roomB":len(ROOM_B),
-        "roomC":len(ROOM_C),
-        "roomD":len(ROOM_D),
+        "roomA":len(ROOM_A) + peer_room_size("A"),
+        "roomB":len(ROOM_B) + peer_room_size("B"),
+        "roomC":len(ROOM_C) + peer_room_size("C"),
+        "roomD":len(ROOM_D) + peer_room_size("D"),
     }))
 
 async def check_username(websocket, username):
@@ -145,9 +262,12 @@ async def check_username(websocket, username):
     for user, name in USERNAMES.items():
         if name == username:
             valid = False
+    if PEER and username in PEER.names:
+        valid = False
     if valid:
         USERNAMES[websocket] = username
-    await websocket.send(json.dumps({
+        send_presence()
+    await send(websocket, fastjson.dumps({
         "type": "username",
         "valid": valid
     }))
@@ -158,30 +278,31 @@ async def join_room(websocket, room):
         success = False
     else:
         if room == "A":
-            if len(ROOM_A) == 16:
+            if len(ROOM_A) + peer_room_size("A") >= 16:
                 success = False
             else:
                 ROOM_A.add(websocket)
                 await room_join("A", USERNAMES[websocket])
         elif room == "B":
-            if len(ROOM_B) == 16:
+            if len(ROOM_B) + peer_room_size("B") >= 16:
                 success = False
             else:
                 ROOM_B.add(websocket)
                 await room_join("B", USERNAMES[websocket])
         elif room == "C":
-            if len(ROOM_C) == 16:
+            if len(ROOM_C) + peer_room_size("C") >= 16:
                 success = False
             else:
                 ROOM_C.add(websocket)
                 await room_join("C", USERNAMES[websocket])
         elif room == "D":
-            if len(ROOM_D) == 16:
+            if len(ROOM_D) + peer_room_size("D") >= 16:
                 success = False
             else:
                 ROOM_D.add(websocket)
                 await room_join("D", USERNAMES[websocket])
-    await websocket.send(json.dumps({
+    send_presence()
+    await send(websocket, fastjson.dumps({
         "type": "join",
         "success": success
     }))
@@ -200,6 +321,7 @@ async def leave_room(websocket, room):
         elif room == "D":
             await room_leave("D", USERNAMES[websocket])
             ROOM_D.remove(websocket)
+        send_presence()
 
 join_codes = {"A":0, "B":2, "C":4, "D":6}
 async def room_join(room, username):
@@ -215,34 +337,47 @@ async def room_leave(room, username):
         "data": username
     }, None)
 
+async def fan_out(members, message_json):
+    # all at once: with the small write_limit a slow reader blocks its own
+    # send early, and one at a time that would hold up the whole room. a
+    # member that has gone away does not fail the sender either, anything
+    # else is a bug and gets logged
+    members = list(members)
+    results = await asyncio.gather(*(send(user, message_json) for user in members), return_exceptions=True)
+    for user, result in zip(members, results):
+        if isinstance(result, Exception) and not isinstance(result, websockets.exceptions.ConnectionClosed):
+            trace = "".join(traceback.format_exception(type(result), result, result.__traceback__))
+            await LOGGER.log(f"fan_out: sending to {user.remote_address} failed\n{trace}")
+
 async def send_message(room, message, author):
     try:
         _ = message["user"]
     except KeyError:
         message["user"] = "" if not author else USERNAMES[author]
 
-    messageJson = json.dumps({
+    messageJson = fastjson.dumps({
         "type": "message",
         "message": message
     })
 
     if room == "A":
-        for user in ROOM_A:
-            await user.send(messageJson)
+        await fan_out(ROOM_A, messageJson)
     elif room == "B":
-        for user in ROOM_B:
-            await user.send(messageJson)
+        await fan_out(ROOM_B, messageJson)
     elif room == "C":
-        for user in ROOM_C:
-            await user.send(messageJson)
+        await fan_out(ROOM_C, messageJson)
     elif room == "D":
-        for user in ROOM_D:
-            await user.send(messageJson)
+        await fan_out(ROOM_D, messageJson)
     else:
         await log(f"send_message: unknown room ({room.__repr__()})")
+        return
+
+    if PEER:
+        PEER.send({"type": "room", "room": room, "message": messageJson})
 
 async def register(websocket):
     USERS.add(websocket)
+    LAST_SEEN[websocket] = time.monotonic()
 
 async def unregister(websocket):
     username = ""
@@ -254,6 +389,11 @@ async def unregister(websocket):
     if websocket in AUTH_USERS:
         AUTH_USERS.pop(websocket)
 
+    batch = BATCHES.pop(websocket, None)
+    if batch:
+        await flush_batch(websocket, batch)
+    LAST_SEEN.pop(websocket, None)
+
     if websocket in ROOM_A:
         ROOM_A.remove(websocket)
         await room_leave("A", username)
@@ -269,9 +409,10 @@ async def unregister(websocket):
 
     if websocket in USERS:
         USERS.remove(websocket)
+    send_presence()
 
 async def send_sys_message(websocket, message):
-    await websocket.send(json.dumps({
+    await send(websocket, fastjson.dumps({
         "type": "message",
         "message": {
             "type": 10,
@@ -329,6 +470,10 @@ async def admin_command(websocket, data):
                     break
             else:
                 await send_sys_message(websocket, "User not found")
+        elif command == "mem":
+            report = memory_report()
+            await LOGGER.log(report)
+            await send_sys_message(websocket, report)
         elif command == "motd":
             message = " ".join(args)
             await set_motd(message)
@@ -343,7 +488,7 @@ async def preflight_ws_message(message):
         return False
 
     try:
-        m_json = json.loads(message)
+        m_json = fastjson.loads(message)
     except ValueError:
         return False
 
@@ -382,6 +527,13 @@ async def preflight_picto_username(message):
         return False
     return True
 
+async def preflight_picto_batch(message):
+    if type(message["window"]) is not int:
+        return False
+    if message["window"] < 0:
+        return False
+    return True
+
 async def abort_connection(websocket, code=1008, reason="Policy violation"):
     await websocket.close(code, reason)
     await LOGGER.log({"action": "abort", "remote": websocket.remote_address, "reason": f"{code}: {reason}"})
@@ -391,6 +543,57 @@ async def finish_him(websocket):
     await set_ban(websocket.remote_address[0])
     await abort_connection(websocket)
 
+def connection_memory(websocket):
+    # bytes held for one connection: unparsed input, received messages not
+    # handled yet, unsent output, batched messages and compression state
+    size = wsdeflate.state_size(websocket)
+    if websocket.transport:
+        size += websocket.transport.get_write_buffer_size()
+    size += len(getattr(websocket.reader, "_buffer", b""))
+    size += sum(len(m) for m in websocket.messages)
+    batch = BATCHES.get(websocket)
+    if batch:
+        size += sum(len(m) for m in batch.messages)
+    return size
+
+def memory_report(top=5):
+    sizes = sorted(((connection_memory(ws), ws) for ws in USERS), key=lambda x: -x[0])
+    total = sum(size for size, _ in sizes)
+    worst = ", ".join(
+        f"{USERNAMES.get(ws, ws.remote_address[0])} {size / 1024:.1f}K" for size, ws in sizes[:top]
+    )
+    return f"{len(sizes)} connections, {total / 1024:.1f}K held (largest: {worst or '-'})"
+
+async def reap_idle():
+    # pings take care of dead sockets, this closes live ones whose
+    # client has not sent anything for idle_timeout seconds
+    while True:
+        timeout = CONFIG["idle_timeout"]
+        await asyncio.sleep(min(timeout, 30) if timeout else 30)
+        if not timeout:
+            continue
+        now = time.monotonic()
+        idle = [ws for ws, seen in LAST_SEEN.items() if now - seen > timeout]
+        for ws in idle:
+            # closing can take up to close_timeout, don't abort it again
+            del LAST_SEEN[ws]
+        if idle:
+            await asyncio.gather(*(abort_connection(ws, 1001, "Idle timeout") for ws in idle), return_exceptions=True)
+
+async def filter_message(websocket, data):
+    # masks message text in place; returns the action taken, or None
+    if CHAT_FILTER.maybe_reload():
+        await LOGGER.log(f"chat filter loaded ({CHAT_FILTER.patterns} patterns)")
+    action, text, words = CHAT_FILTER.check(data["message"]["data"])
+    if action is None:
+        return None
+    await LOGGER.log({"action": "filter", "remote": websocket.remote_address, "result": action, "words": words})
+    if action == "finish_him":
+        await finish_him(websocket)
+    else:
+        data["message"]["data"] = text
+    return action
+
 async def check_and_terminate(the_check, data, websocket):
     if not await the_check(data):
         await finish_him(websocket)
@@ -406,13 +609,14 @@ async def app(websocket, path):
 
     await LOGGER.log({"action": "connect", "remote": websocket.remote_address})
     await register(websocket)
-    await websocket.send(json.dumps({
+    await websocket.send(fastjson.dumps({
         "type": "message",
         "message": {"type": 8, "user": "[SYSTEM]", "data": await get_motd()}
     }))
 
     try:
         async for message in websocket:
+            LAST_SEEN[websocket] = time.monotonic()
             data = await preflight_ws_message(message)
             if data is False:
                 await finish_him(websocket)
@@ -437,13 +641,22 @@ async def app(websocket, path):
             elif action == "message":
                 if await check_and_terminate(preflight_picto_message, data, websocket): return
                 if not await admin_command(websocket, data):
-                    await send_message(data["room"], data["message"], websocket)
+                    result = await filter_message(websocket, data)
+                    if result == "finish_him": return
+                    if result != "drop":
+                        await send_message(data["room"], data["message"], websocket)
+            elif action == "batch":
+                if await check_and_terminate(preflight_picto_batch, data, websocket): return
+                await set_batching(websocket, data["window"])
             else:
                 await finish_him(websocket)
                 return
+    except websockets.exceptions.ConnectionClosed:
+        # closed with an error code, e.g. 1012 while draining for a restart
+        pass
     finally:
         await unregister(websocket)
-    await LOGGER.log({"action": "disconnect", "remote": websocket.remote_address})
+        await LOGGER.log({"action": "disconnect", "remote": websocket.remote_address})
 
 address = ("0.0.0.0", 8069)
 ssl_context = None
@@ -451,13 +664,156 @@ if os.path.exists("fullchain.pem") and os.path.exists("privkey.pem"):
     import ssl
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain("fullchain.pem", "privkey.pem")
-start_server = websockets.serve(app, address[0], address[1], ssl=ssl_context)
+
+def serve(host, port, ssl=None, sock=None):
+    extensions = [wsdeflate.factory(CONFIG)] if CONFIG["deflate"] else []
+    return websockets.serve(
+        app, host, port, ssl=ssl, sock=sock,
+        compression=None, extensions=extensions,
+        max_size=CONFIG["max_size"],
+        max_queue=CONFIG["max_queue"],
+        read_limit=CONFIG["read_limit"],
+        write_limit=CONFIG["write_limit"],
+        ping_interval=CONFIG["ping_interval"],
+        ping_timeout=CONFIG["ping_timeout"],
+        close_timeout=CONFIG["close_timeout"],
+    )
+
+start_server = serve(address[0], address[1], ssl_context)
+SERVER = None
+
+# zero-downtime restart: on SIGUSR2 the running server starts a new one,
+# handing it the listening socket (LISTEN_FD) and one end of a socketpair
+# (PEER_FD). the old process stops accepting and closes its clients a few
+# at a time over drain_time; until it is gone both processes relay room
+# messages to each other and share who is online and in which room, so
+# rooms, name checks and room limits behave as one server.
+class Peer:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.names = set()
+        self.rooms = {}
+        self.ready = asyncio.Event()
+        self.rotated = asyncio.Event()
+
+    def send(self, message):
+        self.writer.write((fastjson.dumps(message) + "\n").encode())
+
+    async def run(self):
+        global PEER
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            message = fastjson.loads(line)
+            if message["type"] == "presence":
+                self.names = set(message["names"])
+                self.rooms = message["rooms"]
+            elif message["type"] == "room":
+                await fan_out(ROOMS[message["room"]], message["message"])
+            elif message["type"] == "ready":
+                self.ready.set()
+            elif message["type"] == "rotate":
+                # the old server has paused its logging
+                LOGGER.open()
+                LOGGER.LOG_FILE.reconfigure(line_buffering=True)
+                self.send({"type": "rotated"})
+            elif message["type"] == "rotated":
+                self.rotated.set()
+        if PEER is self:
+            PEER = None
+        self.rotated.set()
+        if LOGGER.deferred:
+            # the old server went away before asking for the rotation
+            LOGGER.open()
+        self.writer.close()
+
+PEER = None
+
+def peer_room_size(room):
+    return PEER.rooms.get(room, 0) if PEER else 0
+
+def send_presence():
+    if PEER:
+        PEER.send({
+            "type": "presence",
+            "names": list(USERNAMES.values()),
+            "rooms": {room: len(members) for room, members in ROOMS.items()},
+        })
+
+async def connect_peer(sock):
+    global PEER
+    reader, writer = await asyncio.open_connection(sock=sock)
+    PEER = Peer(reader, writer)
+    asyncio.ensure_future(PEER.run())
+    send_presence()
+
+async def hand_off():
+    if PEER:
+        return
+    listener = SERVER.server.sockets[0]
+    ours, theirs = socket.socketpair()
+    env = dict(os.environ, LISTEN_FD=str(listener.fileno()), PEER_FD=str(theirs.fileno()))
+
+    await LOGGER.log("handing off to a new server process")
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)],
+        pass_fds=(listener.fileno(), theirs.fileno()), env=env
+    )
+    theirs.close()
+    await connect_peer(ours)
+    try:
+        await asyncio.wait_for(PEER.ready.wait(), 30)
+    except asyncio.TimeoutError:
+        child.kill()
+        await LOGGER.log("new server did not start, carrying on")
+        return
+
+    # the new server rotates log.json while this one is not writing to it
+    LOGGER.pause()
+    PEER.send({"type": "rotate"})
+    try:
+        await asyncio.wait_for(PEER.rotated.wait(), 10)
+    except asyncio.TimeoutError:
+        pass
+    LOGGER.resume()
+
+    # the new process accepts from the same socket, so this one just
+    # stops listening and lets its own connections go over time
+    SERVER.server.close()
+    await LOGGER.log(f"new server running (pid {child.pid}), draining {len(USERS)} connections")
+    users = list(USERS)
+    random.shuffle(users)
+    for websocket in users:
+        await asyncio.sleep(CONFIG["drain_time"] / len(users))
+        if websocket in USERS:
+            asyncio.ensure_future(abort_connection(websocket, 1012, "Server restarting"))
+    while USERS or not LOGGER.LOG_QUEUE.empty():
+        await asyncio.sleep(0.5)
+    LOGGER.close()
+    asyncio.get_event_loop().stop()
+
+async def take_over():
+    # started by hand_off() in the old process
+    listener = socket.socket(fileno=int(os.environ.pop("LISTEN_FD")))
+    peer = socket.socket(fileno=int(os.environ.pop("PEER_FD")))
+    server = await serve(None, None, ssl_context, listener)
+    await connect_peer(peer)
+    PEER.send({"type": "ready"})
+    return server
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.create_task(LOGGER.log_loop())
-    loop.run_until_complete(LOGGER.log(f"running server on {address[0]}:{address[1]}"))
-    loop.run_until_complete(start_server)
+    loop.create_task(reap_idle())
+    if "LISTEN_FD" in os.environ:
+        loop.run_until_complete(LOGGER.log("taking over from the previous server"))
+        SERVER = loop.run_until_complete(take_over())
+    else:
+        loop.run_until_complete(LOGGER.log(f"running server on {address[0]}:{address[1]}"))
+        SERVER = loop.run_until_complete(start_server)
+    loop.add_signal_handler(signal.SIGUSR2, lambda: loop.create_task(hand_off()))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -0,0 +1,32 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loganalytics import ROOM_LIMIT, LogStats
+
+
+def write_log(path, items):
+    with open(path, "w") as f:
+        for item in items:
+            f.write(json.dumps(item) + "\n")
+
+
+def test_rejected_join_is_not_counted(tmp_path):
+    log = tmp_path / "log.json"
+    items = []
+    for port in range(ROOM_LIMIT + 1):
+        remote = ["10.0.0.1", port]
+        items.append({"action": "connect", "remote": remote})
+        items.append({"action": "join", "remote": remote, "room": "A"})
+    # the last join was turned down, so the one that leaves frees a place
+    # and the count stays at the limit
+    items.append({"action": "leave", "remote": ["10.0.0.1", 0], "room": "A"})
+    items.append({"action": "join", "remote": ["10.0.0.1", 0], "room": "A"})
+    write_log(log, items)
+
+    stats = LogStats().feed_file(str(log))
+
+    assert stats.peak_rooms["A"] == ROOM_LIMIT
+    assert stats.peak_rooms["B"] == 0
@@ -0,0 +1,24 @@
+import base64
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logimage import IMAGE_SIZE
+from logexport import render_sheet
+
+
+def test_bad_drawing_gets_blank_cell(tmp_path):
+    # all black, then one the decoder can't read
+    black = base64.b64encode(b"\xff" * 2300).decode()
+    filename = str(tmp_path / "sheet.png")
+
+    render_sheet(filename, [black, "!" * 3068], 2, 1)
+
+    width, height = IMAGE_SIZE
+    with Image.open(filename) as sheet:
+        assert sheet.size == (2 * width, height)
+        assert sheet.getpixel((0, 0))[:3] == (0, 0, 0)
+        assert sheet.getpixel((width, 0))[:3] == (0xff, 0xff, 0xff)
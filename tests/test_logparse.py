@@ -0,0 +1,44 @@
+import gzip
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logparse import LogSession
+
+
+def write_log(path, times):
+    lines = "".join(json.dumps({"action": "connect", "timestamp": ts}) + "\n" for ts in times)
+    if path.endswith(".gz"):
+        with gzip.open(path, "wt") as f:
+            f.write(lines)
+    else:
+        with open(path, "w") as f:
+            f.write(lines)
+
+
+def test_session_merges_files_and_keeps_recent_ones(tmp_path):
+    # the second archive starts before the first one ends, like two server
+    # processes writing during a handoff
+    first = str(tmp_path / "log-20210601-120000.json.gz")
+    second = str(tmp_path / "log-20210602-120000.json.gz")
+    write_log(first, ["2021-06-01 10:00:00", "2021-06-01 12:00:00"])
+    write_log(second, ["2021-06-01 11:00:00", "2021-06-02 11:00:00"])
+
+    session = LogSession([first, second], cache_files=1)
+    expected = ["2021-06-01 10:00:00", "2021-06-01 11:00:00", "2021-06-01 12:00:00", "2021-06-02 11:00:00"]
+    assert [item["timestamp"] for item in session] == expected
+    assert list(session.cache) == [second]
+    assert [item["timestamp"] for item in session] == expected
+
+
+def test_session_keeps_only_files_read_to_the_end(tmp_path):
+    path = str(tmp_path / "log-20210601-120000.json.gz")
+    write_log(path, ["2021-06-01 10:00:00", "2021-06-01 11:00:00"])
+
+    session = LogSession([path])
+    items = iter(session)
+    next(items)
+    del items
+    assert not session.cache
@@ -0,0 +1,129 @@
+import asyncio
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeSocket:
+    remote_address = ("127.0.0.1", 50000)
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # server.py sets up log.json, the ban list and friends in the working
+    # directory when it is imported
+    monkeypatch.chdir(tmp_path)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sys.modules.pop("server", None)
+    yield importlib.import_module("server")
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def logged(server):
+    entries = []
+    while not server.LOGGER.LOG_QUEUE.empty():
+        line, _ = server.LOGGER.LOG_QUEUE.get_nowait()
+        entries.append(json.loads(line))
+    return entries
+
+
+def test_log_keeps_unmasked_message(server):
+    server.CHAT_FILTER.set_patterns([("darn", "mask")])
+    server.CHAT_FILTER.checked = float("inf") # no reloading from filter.txt
+    data = {"action": "message", "room": "A", "message": {"type": 0, "data": "hi darn there", "image": ""}}
+
+    async def handle():
+        await server.LOGGER.log(data)
+        return await server.filter_message(FakeSocket(), data)
+
+    assert run(handle()) == "mask"
+    assert data["message"]["data"] == "hi **** there"
+    entries = logged(server)
+    assert entries[0]["message"]["data"] == "hi darn there"
+    assert entries[1]["action"] == "filter"
+    assert entries[1]["words"] == ["darn"]
+
+
+def test_unregister_flushes_pending_batch(server):
+    websocket = FakeSocket()
+
+    async def handle():
+        await server.set_batching(websocket, 50)
+        await server.send(websocket, '{"n":1}')
+        await server.send(websocket, '{"n":2}')
+        task = server.BATCHES[websocket].task
+        await server.unregister(websocket)
+        await asyncio.sleep(0)
+        return task
+
+    task = run(handle())
+    assert task.cancelled()
+    assert websocket.sent[-1] == '[{"n":1},{"n":2}]'
+    assert websocket not in server.BATCHES
+
+
+class StalledSocket(FakeSocket):
+    # a reader whose send() waits until released, like a full write buffer
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+
+    async def send(self, message):
+        await self.release.wait()
+        self.sent.append(message)
+
+
+def test_room_fan_out_does_not_wait_for_slow_reader(server):
+    slow = StalledSocket()
+    fast = FakeSocket()
+    server.ROOM_A.update((slow, fast))
+
+    async def handle():
+        sending = asyncio.ensure_future(server.send_message("A", {"type": 0, "data": "hi", "user": "x"}, None))
+        await asyncio.sleep(0.01)
+        delivered = list(fast.sent)
+        slow.release.set()
+        await sending
+        return delivered
+
+    assert len(run(handle())) == 1
+    assert len(slow.sent) == 1
+
+
+class FailingSocket(FakeSocket):
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    async def send(self, message):
+        raise self.error
+
+
+def test_fan_out_logs_unexpected_errors_only(server):
+    closed = FailingSocket(server.websockets.exceptions.ConnectionClosed(1001, "going away"))
+    broken = FailingSocket(RuntimeError("boom"))
+    fine = FakeSocket()
+
+    run(server.fan_out([closed, broken, fine], "{}"))
+
+    assert fine.sent == ["{}"]
+    errors = [json.dumps(entry) for entry in logged(server)]
+    assert len(errors) == 1
+    assert "fan_out" in errors[0] and "RuntimeError: boom" in errors[0]
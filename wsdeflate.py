@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import re
+import zlib
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, OP_CONT, Frame
+
+# a drawing is 3068 base64 characters, mostly runs of "A" for white; the
+# rest of the protocol is small json that deflate barely shrinks
+IMAGE_RE = re.compile(rb'"image": ?"[^"]')
+EMPTY_BLOCK = b"\x00\x00\xff\xff"
+
+class DeflatePolicy:
+    def __init__(self, min_size=512, images_only=True):
+        self.min_size = min_size
+        self.images_only = images_only
+
+    def wants(self, data):
+        if len(data) < self.min_size:
+            return False
+        return not self.images_only or IMAGE_RE.search(data) is not None
+
+class SharedCache:
+    # compressed payloads by (window bits, payload); small, a broadcast
+    # goes out to a room within a few milliseconds
+    def __init__(self, size=32):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        self.entries[key] = data
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+def deflate(data, window_bits, settings):
+    encoder = zlib.compressobj(wbits=-window_bits, **settings)
+    data = encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+    if data.endswith(EMPTY_BLOCK):
+        data = data[:-4]
+    return data
+
+class PolicyDeflate(PerMessageDeflate):
+    # permessage-deflate lets every message choose whether it is
+    # compressed (rsv1), so frames the policy skips go out as they are.
+    # without context takeover each message is compressed on its own, the
+    # same payload always gives the same bytes, and a message broadcast to
+    # a room is compressed once for everyone on the same window size
+    def __init__(self, remote_no_context_takeover, local_no_context_takeover,
+                 remote_max_window_bits, local_max_window_bits, compress_settings, policy, cache):
+        super().__init__(remote_no_context_takeover, local_no_context_takeover,
+                         remote_max_window_bits, local_max_window_bits, compress_settings)
+        self.policy = policy
+        self.cache = cache
+        self.encode_cont_data = False
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode == OP_CONT:
+            if not self.encode_cont_data:
+                return frame
+            if frame.fin:
+                self.encode_cont_data = False
+            return super().encode(frame)
+
+        if not self.policy.wants(frame.data):
+            return frame
+        if frame.fin and self.local_no_context_takeover:
+            key = (self.local_max_window_bits, frame.data)
+            data = self.cache.get(key)
+            if data is None:
+                data = deflate(frame.data, self.local_max_window_bits, self.compress_settings)
+                self.cache.put(key, data)
+            # keywords, the field order of Frame changed in websockets 10
+            return Frame(fin=frame.fin, opcode=frame.opcode, data=data, rsv1=True, rsv2=frame.rsv2, rsv3=frame.rsv3)
+        self.encode_cont_data = not frame.fin
+        return super().encode(frame)
+
+class PolicyDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, policy, window_bits=None, mem_level=8, level=6, context_takeover=True):
+        super().__init__(
+            server_no_context_takeover=not context_takeover,
+            client_no_context_takeover=not context_takeover,
+            server_max_window_bits=window_bits,
+            compress_settings={"memLevel": mem_level, "level": level},
+        )
+        self.policy = policy
+        self.client_window_bits = window_bits
+        self.cache = SharedCache()
+
+    def process_request_params(self, params, accepted_extensions):
+        # limiting the client's window is only possible when it offered
+        # to accept a limit, the base class refuses compression otherwise.
+        # decided per handshake, this factory is shared by all of them
+        offered = any(name == "client_max_window_bits" for name, _ in params)
+        negotiate = ServerPerMessageDeflateFactory(
+            server_no_context_takeover=self.server_no_context_takeover,
+            client_no_context_takeover=self.client_no_context_takeover,
+            server_max_window_bits=self.server_max_window_bits,
+            client_max_window_bits=self.client_window_bits if offered else None,
+            compress_settings=self.compress_settings,
+        )
+        response, extension = negotiate.process_request_params(params, accepted_extensions)
+        return response, PolicyDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            self.policy,
+            self.cache,
+        )
+
+def factory(config):
+    # the deflate_* keys of server.conf
+    return PolicyDeflateFactory(
+        DeflatePolicy(config["deflate_min_size"], config["deflate_images_only"]),
+        window_bits=config["deflate_window_bits"],
+        mem_level=config["deflate_mem_level"],
+        level=config["deflate_level"],
+        context_takeover=config["deflate_context_takeover"],
+    )
+
+def state_size(websocket):
+    # rough bytes of zlib state a connection keeps between messages,
+    # following zlib's own sizing (zconf.h)
+    size = 0
+    for extension in websocket.extensions:
+        if not isinstance(extension, PerMessageDeflate):
+            continue
+        if not extension.local_no_context_takeover:
+            mem_level = (extension.compress_settings or {}).get("memLevel", 8)
+            size += (1 << (extension.local_max_window_bits + 2)) + (1 << (mem_level + 9))
+        if not extension.remote_no_context_takeover:
+            size += (1 << extension.remote_max_window_bits) + 7 * 1024
+    return size